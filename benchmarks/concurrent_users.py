@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# Copyright © 2017 Tom Hacohen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure how request throughput scales with the number of concurrent users.
+
+Runs against an already running etesync-dav instance, with the DAV credentials (as shown by
+`etesync-dav manage get`) of a few users that have already been synced:
+
+    python benchmarks/concurrent_users.py --url http://localhost:37358 alice:pass1 bob:pass2 carol:pass3
+
+For 1..N users, each user gets its own client thread issuing PROPFIND requests on its collections for the
+given duration. With requests of unrelated users running in parallel, the total throughput should grow with
+the number of users rather than stay flat.
+"""
+
+import argparse
+import base64
+import threading
+import time
+import urllib.request
+
+PROPFIND_BODY = b"""<?xml version="1.0" encoding="utf-8"?>
+<propfind xmlns="DAV:"><prop><getetag/><resourcetype/></prop></propfind>
+"""
+
+
+def propfind(url, username, password):
+    auth = base64.b64encode("{}:{}".format(username, password).encode()).decode()
+    request = urllib.request.Request(
+        url,
+        data=PROPFIND_BODY,
+        method="PROPFIND",
+        headers={"Authorization": "Basic " + auth, "Depth": "1", "Content-Type": "application/xml"},
+    )
+    with urllib.request.urlopen(request) as response:
+        response.read()
+
+
+def run(url, users, duration):
+    counts = [0] * len(users)
+    deadline = time.monotonic() + duration
+
+    def client(idx, username, password):
+        user_url = "{}/{}/".format(url.rstrip("/"), username)
+        while time.monotonic() < deadline:
+            propfind(user_url, username, password)
+            counts[idx] += 1
+
+    threads = [threading.Thread(target=client, args=(idx, *user)) for idx, user in enumerate(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return sum(counts) / duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:37358", help="The URL of the running etesync-dav")
+    parser.add_argument("--duration", type=float, default=10, help="How long to run each round, in seconds")
+    parser.add_argument("users", nargs="+", help="username:password pairs of the DAV logins to use")
+    args = parser.parse_args()
+
+    users = [user.split(":", 1) for user in args.users]
+
+    # Warm up, so the initial sync of every user is not measured
+    for username, password in users:
+        propfind("{}/{}/".format(args.url.rstrip("/"), username), username, password)
+
+    baseline = None
+    for count in range(1, len(users) + 1):
+        throughput = run(args.url, users[:count], args.duration)
+        baseline = baseline or throughput
+        print("{} users: {:.1f} req/s ({:.2f}x)".format(count, throughput, throughput / baseline))
+
+
+if __name__ == "__main__":
+    main()
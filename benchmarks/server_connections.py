@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# Copyright © 2017 Tom Hacohen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure how request throughput holds up with a growing number of idle client connections.
+
+Runs against an already running etesync-dav instance, so start it once per server mode and compare the results:
+
+    ETESYNC_SERVER_MODE=threaded etesync-dav
+    python benchmarks/server_connections.py --url http://localhost:37358
+
+    ETESYNC_SERVER_MODE=asyncio etesync-dav
+    python benchmarks/server_connections.py --url http://localhost:37358
+
+For every number of idle connections, these are opened first and each sends a single request and then stays
+open, like mobile clients keeping their connection alive. Connections the server doesn't accept in time are counted
+as failed. A few active clients then issue requests over kept alive connections for the given duration. Without DAV
+credentials the requests are OPTIONS, otherwise PROPFINDs on the user's collections.
+"""
+
+import argparse
+import base64
+import http.client
+import selectors
+import socket
+import threading
+import time
+import urllib.parse
+
+PROPFIND_BODY = b"""<?xml version="1.0" encoding="utf-8"?>
+<propfind xmlns="DAV:"><prop><getetag/><resourcetype/></prop></propfind>
+"""
+
+
+def raise_fd_limit():
+    try:
+        import resource
+    except ImportError:
+        # Not available on Windows
+        return
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def open_idle(url, count, timeout):
+    """Open the connections in parallel, returns the ones that could connect in time and how many couldn't."""
+    family, type_, proto, _, address = socket.getaddrinfo(url.hostname, url.port or 80, type=socket.SOCK_STREAM)[0]
+    request = "OPTIONS / HTTP/1.1\r\nHost: {}\r\n\r\n".format(url.netloc).encode()
+    selector = selectors.DefaultSelector()
+    for _ in range(count):
+        sock = socket.socket(family, type_, proto)
+        sock.setblocking(False)
+        sock.connect_ex(address)
+        selector.register(sock, selectors.EVENT_WRITE)
+
+    connections = []
+    deadline = time.monotonic() + timeout
+    while selector.get_map() and time.monotonic() < deadline:
+        for key, _ in selector.select(deadline - time.monotonic()):
+            sock = key.fileobj
+            selector.unregister(sock)
+            if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                sock.setblocking(True)
+                sock.sendall(request)
+                connections.append(sock)
+            else:
+                sock.close()
+
+    for key in list(selector.get_map().values()):
+        key.fileobj.close()
+    selector.close()
+    return connections, count - len(connections)
+
+
+def run(url, clients, duration, credentials, timeout):
+    counts = [0] * clients
+    errors = [0] * clients
+    deadline = time.monotonic() + duration
+    if credentials is not None:
+        username, password = credentials
+        auth = base64.b64encode("{}:{}".format(username, password).encode()).decode()
+        method, path, body = "PROPFIND", "/{}/".format(username), PROPFIND_BODY
+        headers = {"Authorization": "Basic " + auth, "Depth": "1", "Content-Type": "application/xml"}
+    else:
+        method, path, body, headers = "OPTIONS", "/", None, {}
+
+    def client(idx):
+        connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=timeout)
+        while time.monotonic() < deadline:
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                connection.getresponse().read()
+                counts[idx] += 1
+            except (OSError, http.client.HTTPException):
+                errors[idx] += 1
+                connection.close()
+        connection.close()
+
+    threads = [threading.Thread(target=client, args=(idx,)) for idx in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return sum(counts) / duration, sum(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:37358", help="The URL of the running etesync-dav")
+    parser.add_argument("--duration", type=float, default=10, help="How long to run each round, in seconds")
+    parser.add_argument("--clients", type=int, default=4, help="The number of active clients")
+    parser.add_argument("--timeout", type=float, default=10, help="Timeout of connecting and of requests, in seconds")
+    parser.add_argument(
+        "--idle", type=int, nargs="+", default=[0, 10, 100, 1000], help="The numbers of idle connections to try"
+    )
+    parser.add_argument("--credentials", help="username:password of a DAV login to PROPFIND with")
+    args = parser.parse_args()
+
+    url = urllib.parse.urlsplit(args.url)
+    credentials = args.credentials.split(":", 1) if args.credentials else None
+    raise_fd_limit()
+
+    for idle in args.idle:
+        connections, failed = open_idle(url, idle, args.timeout)
+        try:
+            throughput, errors = run(url, args.clients, args.duration, credentials, args.timeout)
+        finally:
+            for sock in connections:
+                sock.close()
+        print(
+            "{} idle connections ({} failed to connect): {:.1f} req/s, {} errors".format(
+                idle, failed, throughput, errors
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
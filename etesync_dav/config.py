@@ -29,6 +29,24 @@ ETESYNC_URL = os.environ.get("ETESYNC_URL", "https://api.etebase.com/partner/ete
 LEGACY_ETESYNC_URL = os.environ.get("ETESYNC_URL", "https://api.etesync.com/")
 DATABASE_FILE = os.environ.get("ETESYNC_DATABASE_FILE", os.path.join(DATA_DIR, "etesync_data.db"))
 ETEBASE_DATABASE_FILE = os.environ.get("ETEBASE_DATABASE_FILE", os.path.join(DATA_DIR, "etebase_data.db"))
+# Give every user their own database file, named after the template with "{}" replaced by a hash of the username
+ETEBASE_DATABASE_PER_USER = bool(os.environ.get("ETEBASE_DATABASE_PER_USER"))
+ETEBASE_USER_DATABASE_FILE = os.environ.get("ETEBASE_USER_DATABASE_FILE", os.path.join(DATA_DIR, "etebase_data_{}.db"))
+# Also keep the (compressed and locally encrypted) content of items in the database for faster reads
+ETEBASE_CACHE_PLAINTEXT = bool(os.environ.get("ETEBASE_CACHE_PLAINTEXT"))
+# Memory (in bytes) used for caching decrypted and parsed items
+ITEM_CACHE_SIZE = int(os.environ.get("ETESYNC_ITEM_CACHE_SIZE", 64 * 1024 * 1024))
+# How many collections are synced with the server in parallel
+SYNC_CONCURRENCY = int(os.environ.get("ETESYNC_SYNC_CONCURRENCY", 4))
+# How long (in seconds) the background sync waits at most when nothing changed, it backs off up to it
+SYNC_INTERVAL_IDLE = int(os.environ.get("ETESYNC_SYNC_INTERVAL_IDLE", 60 * 60))
+# Make read requests wait for a running background sync instead of serving what's in the local cache
+BLOCKING_READS = bool(os.environ.get("ETESYNC_BLOCKING_READS"))
+# "threaded" for a thread per connection, "pooled" for a fixed number of workers (max_connections) that keep
+# connections alive, or "asyncio" for handling connections asynchronously and only requests in such workers
+SERVER_MODE = os.environ.get("ETESYNC_SERVER_MODE", "threaded")
+# Clients (a regex matched against the User-Agent) that get vCards as stored instead of converted to 3.0
+VCARD4_USER_AGENTS = os.environ.get("ETESYNC_VCARD4_USER_AGENTS", r"DAVx5")
 
 HTPASSWD_FILE = os.path.join(DATA_DIR, "htpaswd")
 CREDS_FILE = os.path.join(DATA_DIR, "etesync_creds")
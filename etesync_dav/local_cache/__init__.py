@@ -1,13 +1,37 @@
+import functools
+import hashlib
+import logging
 import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import msgpack
+import peewee as pw
 from etebase import Account, Client, CollectionAccessLevel, FetchOptions
+from radicale.item import Item as RadicaleItem
 
 from etesync_dav import config
 
 from . import db, models
+from .item_cache import ItemCache
+from .plaintext import PlaintextCipher
+
+logger = logging.getLogger("etesync-dav")
 
 COL_TYPES = ["etebase.vcard", "etebase.vevent", "etebase.vtodo"]
+# The collection types whose items are indexed for calendar queries, address book queries can't use the index
+INDEXED_COL_TYPES = ["etebase.vevent", "etebase.vtodo"]
+
+# How many past local_stokens to keep per collection for serving incremental syncs
+SYNC_TOKEN_HISTORY = 100
+
+# Shared between users, items of shared collections have the same uids and etags for everyone
+item_cache = ItemCache(config.ITEM_CACHE_SIZE)
+
+# Open databases by path, with the locks serializing their schema initialization and migrations between users
+_databases = {}
+_databases_lock = threading.Lock()
 
 
 class StorageException(Exception):
@@ -32,68 +56,362 @@ def batch(iterable, n=1):
         yield iterable[ndx : min(ndx + n, length)]
 
 
+def _call(func):
+    return func()
+
+
+def _content_index(content):
+    """The component name and enclosing time range (with recurrences) of the content, or Nones if unknown."""
+    if content is None:
+        return None, None, None
+
+    try:
+        item = RadicaleItem(collection_path="", text=content.decode())
+        start, end = item.time_range
+        return item.component_name, start, end
+    except Exception:
+        # Will just never be filtered out
+        return None, None, None
+
+
+def _item_columns(plaintext_cipher, uid, item, mtime, col_type):
+    """The values copied from the Etebase item to its ItemEntity, so reads and queries don't need to load it."""
+    content = None if item.deleted else item.content
+    if col_type in INDEXED_COL_TYPES:
+        component_name, time_start, time_end = _content_index(content)
+    else:
+        component_name, time_start, time_end = None, None, None
+    if plaintext_cipher is not None and content is not None:
+        cached_content = plaintext_cipher.encrypt(uid, content)
+    else:
+        cached_content = None
+
+    return {
+        "etag": item.etag,
+        "mtime": mtime,
+        "content": cached_content,
+        "component_name": component_name,
+        "time_start": time_start,
+        "time_end": time_end,
+    }
+
+
 def get_millis():
     import time
 
     return int(round(time.time() * 1000))
 
 
+def _add_column(database, model, name, definition):
+    # Not using playhouse.migrate because it rebuilds the table for NOT NULL columns, which cascades deletes
+    database.execute_sql('ALTER TABLE "{}" ADD COLUMN "{}" {}'.format(model._meta.table_name, name, definition))
+
+
+def _next_change_seq(collection_id):
+    """Allocate a new change sequence number in the collection. Must be called in a transaction."""
+    # Updating first takes the write lock, so concurrent writers can't allocate the same number
+    models.CollectionEntity.update(change_seq=models.CollectionEntity.change_seq + 1).where(
+        models.CollectionEntity.id == collection_id
+    ).execute()
+    change_seq = (
+        models.CollectionEntity.select(models.CollectionEntity.change_seq)
+        .where(models.CollectionEntity.id == collection_id)
+        .scalar()
+    )
+
+    # The row may have been overwritten with an older number, so never go below the items'. Not only relying on
+    # the items, as numbers allocated for pages without items may have been recorded for a stoken already.
+    max_item_seq = (
+        models.ItemEntity.select(pw.fn.MAX(models.ItemEntity.change_seq))
+        .where(models.ItemEntity.collection == collection_id)
+        .scalar()
+    )
+    if max_item_seq is not None and change_seq <= max_item_seq:
+        change_seq = max_item_seq + 1
+        models.CollectionEntity.update(change_seq=change_seq).where(
+            models.CollectionEntity.id == collection_id
+        ).execute()
+
+    return change_seq
+
+
+def _record_sync_token(cache_col):
+    """Remember the change sequence number the collection's current local_stoken maps to, and forget old ones."""
+    if cache_col.local_stoken is None:
+        return
+
+    models.SyncTokenEntity.insert(
+        collection=cache_col, stoken=cache_col.local_stoken, change_seq=cache_col.change_seq
+    ).on_conflict_ignore().execute()
+
+    # Forget old tokens, clients that still have them will just do a full sync
+    keep = (
+        models.SyncTokenEntity.select(models.SyncTokenEntity.id)
+        .where(models.SyncTokenEntity.collection == cache_col)
+        .order_by(models.SyncTokenEntity.id.desc())
+        .limit(SYNC_TOKEN_HISTORY)
+    )
+    models.SyncTokenEntity.delete().where(
+        (models.SyncTokenEntity.collection == cache_col) & models.SyncTokenEntity.id.not_in(keep)
+    ).execute()
+
+
+def _get_database(db_path):
+    """Get the database for the path and its initialization lock, shared by all of its users so each thread has one
+    connection per file."""
+    with _databases_lock:
+        ret = _databases.get(db_path)
+        if ret is None:
+            directory = os.path.dirname(db_path)
+            if directory != "" and not os.path.exists(directory):
+                os.makedirs(directory)
+
+            database = db.TrackingDatabase(
+                db_path,
+                pragmas={
+                    "journal_mode": "wal",
+                    "foreign_keys": 1,
+                },
+            )
+            ret = _databases[db_path] = (database, threading.Lock())
+
+        return ret
+
+
 class Etebase:
     def __init__(self, username, stored_session, remote_url=None):
-        db_path = config.ETEBASE_DATABASE_FILE
+        if config.ETEBASE_DATABASE_PER_USER:
+            db_path = config.ETEBASE_USER_DATABASE_FILE.format(hashlib.sha256(username.encode()).hexdigest())
+        else:
+            db_path = config.ETEBASE_DATABASE_FILE
         client = Client("etesync-dav", remote_url)
         self.stored_session = stored_session
         self.etebase = Account.restore(client, stored_session, None)
+        self.plaintext_cipher = PlaintextCipher(stored_session) if config.ETEBASE_CACHE_PLAINTEXT else None
         self.username = username
+        # How many collections sync() went over, and how many of them it skipped because nothing changed
+        self.collections_synced = 0
+        self.collections_skipped = 0
+        # The access levels of the user's collections by uid, loaded when first needed and then kept up to date
+        # when syncing the collection list
+        self._access_levels = None
+        self._access_levels_lock = threading.Lock()
+        # The last loaded collection objects by uid, with the stoken and serialized collection they were loaded from
+        self._loaded_cols = {}
+        self._loaded_cols_lock = threading.Lock()
+        # Set once the user's cache was removed, the instance can't be used anymore then
+        self._cleared = False
 
         self._init_db(db_path)
 
     def reinit(self):
-        self._set_db(self._database)
+        self._set_db(self._database, self._init_lock)
+
+    def bind(self):
+        """Use our database for the models in the calling thread."""
+        if self._cleared:
+            # Would otherwise recreate a removed database
+            raise StorageException("The cache of user {} was removed".format(self.username))
+        db.database_proxy.initialize(self._database)
 
-    def _set_db(self, database):
+    def _set_db(self, database, init_lock):
         self._database = database
+        self._init_lock = init_lock
 
-        db.database_proxy.initialize(database)
+        self.bind()
 
-        with db.database_proxy:
+        with init_lock, db.database_proxy:
             self._init_db_tables(database)
 
             self.user, created = models.User.get_or_create(username=self.username)
 
     def _init_db(self, db_path):
-        from playhouse.sqlite_ext import SqliteExtDatabase
-
-        directory = os.path.dirname(db_path)
-        if directory != "" and not os.path.exists(directory):
-            os.makedirs(directory)
-
-        database = SqliteExtDatabase(
-            db_path,
-            pragmas={
-                "journal_mode": "wal",
-                "foreign_keys": 1,
-            },
+        migrate = config.ETEBASE_DATABASE_PER_USER and not os.path.exists(db_path)
+        database, init_lock = _get_database(db_path)
+        if migrate:
+            with init_lock:
+                self._migrate_from_shared_db(database)
+
+        self._set_db(database, init_lock)
+
+    def _migrate_from_shared_db(self, database):
+        """Copy the user's data from the shared database into their own (new) one, and remove it from there."""
+        shared_path = config.ETEBASE_DATABASE_FILE
+        if not os.path.exists(shared_path):
+            return
+
+        shared_database, shared_init_lock = _get_database(shared_path)
+        db.database_proxy.initialize(shared_database)
+        with shared_init_lock, db.database_proxy:
+            self._init_db_tables(shared_database)
+            user = models.User.get_or_none(username=self.username)
+        if user is None:
+            return
+
+        db.database_proxy.initialize(database)
+        with db.database_proxy:
+            self._init_db_tables(database)
+
+        collections = 'SELECT "id" FROM shared."{}" WHERE "local_user_id" = ?'.format(
+            models.CollectionEntity._meta.table_name
+        )
+        items = 'SELECT "id" FROM shared."{}" WHERE "collection_id" IN ({})'.format(
+            models.ItemEntity._meta.table_name, collections
         )
+        to_copy = [
+            (models.User, '"id" = ?'),
+            (models.CollectionEntity, '"local_user_id" = ?'),
+            (models.ItemEntity, '"collection_id" IN ({})'.format(collections)),
+            (models.HrefMapper, '"content_id" IN ({})'.format(items)),
+            (models.SyncTokenEntity, '"collection_id" IN ({})'.format(collections)),
+        ]
+
+        # Can't attach a database in a transaction, so only open a connection for it
+        with database.connection_context():
+            database.execute_sql("ATTACH DATABASE ? AS shared", (shared_path,))
+            try:
+                with database.atomic():
+                    for model, where in to_copy:
+                        columns = ", ".join('"{}"'.format(field.column_name) for field in model._meta.sorted_fields)
+                        database.execute_sql(
+                            'INSERT INTO main."{table}" ({columns}) SELECT {columns} FROM shared."{table}" WHERE {where}'.format(
+                                table=model._meta.table_name, columns=columns, where=where
+                            ),
+                            (user.id,),
+                        )
+            finally:
+                database.execute_sql("DETACH DATABASE shared")
 
-        self._set_db(database)
+        # Everything else is removed by the cascade
+        db.database_proxy.initialize(shared_database)
+        with db.database_proxy:
+            models.User.delete().where(models.User.id == user.id).execute()
 
     def _init_db_tables(self, database, additional_tables=None):
-        CURRENT_DB_VERSION = 1
+        CURRENT_DB_VERSION = 4
+
+        new_db = not database.table_exists(models.ItemEntity._meta.table_name)
+
+        database.create_tables([models.Config], safe=True)
+        default_db_version = CURRENT_DB_VERSION if new_db else 1
+        config, created = models.Config.get_or_create(defaults={"db_version": default_db_version})
+
+        # Migrations have to run before creating the tables so indexes on new columns can be created
+        if config.db_version < 2:
+            _add_column(database, models.CollectionEntity, "change_seq", "INTEGER NOT NULL DEFAULT 0")
+            _add_column(database, models.ItemEntity, "change_seq", "INTEGER NOT NULL DEFAULT 0")
+
+            config.db_version = 2
+            config.save()
+
+        # Whether columns were added that are filled when pulling, which needs the keys so can't be done here
+        repull = False
+
+        if config.db_version < 3:
+            _add_column(database, models.ItemEntity, "etag", "VARCHAR(255)")
+            _add_column(database, models.ItemEntity, "mtime", "INTEGER")
+            _add_column(database, models.ItemEntity, "content", "BLOB")
+
+            config.db_version = 3
+            config.save()
+            repull = True
+
+        if config.db_version < 4:
+            _add_column(database, models.ItemEntity, "component_name", "VARCHAR(255)")
+            _add_column(database, models.ItemEntity, "time_start", "BIGINT")
+            _add_column(database, models.ItemEntity, "time_end", "BIGINT")
+
+            config.db_version = 4
+            config.save()
+            repull = True
+
+        if repull:
+            # Makes the next sync pull all of the items again, which fills the new columns of the existing ones
+            models.CollectionEntity.update(local_stoken=None).execute()
 
         database.create_tables(
-            [models.Config, models.User, models.CollectionEntity, models.ItemEntity, models.HrefMapper], safe=True
+            [
+                models.User,
+                models.CollectionEntity,
+                models.ItemEntity,
+                models.HrefMapper,
+                models.SyncTokenEntity,
+            ],
+            safe=True,
         )
         if additional_tables:
             database.create_tables(additional_tables, safe=True)
 
-        default_db_version = CURRENT_DB_VERSION
-        config, created = models.Config.get_or_create(defaults={"db_version": default_db_version})
+    def _collections_to_sync(self):
+        """Return the uids of the collections with remote or local changes, and how many were left out."""
+        has_local_changes = pw.fn.EXISTS(
+            models.ItemEntity.select(models.ItemEntity.id).where(
+                (models.ItemEntity.collection == models.CollectionEntity.id)
+                & (models.ItemEntity.dirty | models.ItemEntity.new)
+            )
+        )
+        has_remote_changes = pw.Expression(
+            models.CollectionEntity.stoken, pw.OP.IS_NOT, models.CollectionEntity.local_stoken
+        )
+
+        with db.database_proxy:
+            query = self.user.collections.select(
+                models.CollectionEntity.uid, (has_remote_changes | has_local_changes).alias("changed")
+            ).where(~models.CollectionEntity.deleted)
+            rows = list(query.tuples())
+
+        uids = [uid for uid, changed in rows if changed]
+        return uids, len(rows) - len(uids)
 
     def sync(self):
+        """Sync the collection list and then every collection that changed. Returns the number of synced
+        collections."""
         self.sync_collection_list()
-        for collection in self.list():
-            self.sync_collection(collection.uid)
+
+        uids, skipped = self._collections_to_sync()
+        self.collections_synced += len(uids)
+        self.collections_skipped += skipped
+
+        if config.SYNC_CONCURRENCY <= 1 or len(uids) <= 1:
+            for uid in uids:
+                self.sync_collection(uid)
+        else:
+            self._sync_collections_concurrently(uids)
+
+        logger.debug(
+            "Synced %d collections of %s and skipped %d unchanged ones (%d synced and %d skipped in total)",
+            len(uids),
+            self.username,
+            skipped,
+            self.collections_synced,
+            self.collections_skipped,
+        )
+        return len(uids)
+
+    def _sync_collections_concurrently(self, uids):
+        # Network and crypto run in the workers, while all of the database writes are queued back to this
+        # thread so SQLite only ever has one writer. A None on the queue marks a finished collection.
+        writes = queue.Queue()
+
+        def sync_one(uid):
+            self.bind()
+            try:
+                self.sync_collection(uid, writer=writes.put)
+            finally:
+                writes.put(None)
+
+        with ThreadPoolExecutor(max_workers=config.SYNC_CONCURRENCY, thread_name_prefix="etebase-sync") as executor:
+            futures = [executor.submit(sync_one, uid) for uid in uids]
+            remaining = len(futures)
+            while remaining > 0:
+                write = writes.get()
+                if write is None:
+                    remaining -= 1
+                else:
+                    write()
+
+        for future in futures:
+            future.result()
 
     def sync_collection_list(self):
         self.push_collection_list()
@@ -101,6 +419,7 @@ class Etebase:
         col_mgr = self.etebase.get_collection_manager()
         stoken = self.user.stoken
         done = False
+        access_levels = {}
 
         with db.database_proxy:
             while not done:
@@ -116,13 +435,25 @@ class Etebase:
                     collection.eb_col = col_mgr.cache_save(col)
                     collection.stoken = col.stoken
                     collection.deleted = col.deleted
-                    collection.save()
+                    if collection.id is None:
+                        collection.save()
+                    else:
+                        # The rest of the row may be changed concurrently (e.g. by pulls), so leave it alone
+                        collection.save(
+                            only=[
+                                models.CollectionEntity.eb_col,
+                                models.CollectionEntity.stoken,
+                                models.CollectionEntity.deleted,
+                            ]
+                        )
+                    access_levels[col.uid] = None if col.deleted else col.access_level
 
                 for col_uid in col_list.removed_memberships:
+                    access_levels[col_uid] = None
                     try:
                         collection = models.CollectionEntity.get(local_user=self.user, uid=col_uid)
                         collection.deleted = True
-                        collection.save()
+                        collection.save(only=[models.CollectionEntity.deleted])
                     except models.CollectionEntity.DoesNotExist:
                         # Already removed
                         pass
@@ -133,6 +464,55 @@ class Etebase:
                 self.user.stoken = stoken
                 self.user.save()
 
+        # Only once committed, so a concurrent load can't overwrite them with what was there before
+        self._update_access_levels(access_levels)
+        with self._loaded_cols_lock:
+            for uid, access_level in access_levels.items():
+                if access_level is None:
+                    self._loaded_cols.pop(uid, None)
+
+    def _update_access_levels(self, access_levels):
+        with self._access_levels_lock:
+            if self._access_levels is None:
+                # Will be loaded with the changes when first needed
+                return
+
+            for uid, access_level in access_levels.items():
+                if access_level is None:
+                    self._access_levels.pop(uid, None)
+                else:
+                    self._access_levels[uid] = access_level
+
+    def _load_access_levels(self):
+        with self._access_levels_lock:
+            if self._access_levels is None:
+                col_mgr = self.etebase.get_collection_manager()
+                with db.database_proxy:
+                    cache_cols = list(
+                        self.user.collections.select(models.CollectionEntity.eb_col).where(
+                            ~models.CollectionEntity.deleted
+                        )
+                    )
+                access_levels = {}
+                for cache_col in cache_cols:
+                    col = col_mgr.cache_load(cache_col.eb_col)
+                    access_levels[col.uid] = col.access_level
+                self._access_levels = access_levels
+
+            return self._access_levels
+
+    def is_read_only(self, uid):
+        """Whether the user can only read the collection, without loading it. Raises DoesNotExist for unknown
+        collections."""
+        access_levels = self._access_levels
+        if access_levels is None:
+            access_levels = self._load_access_levels()
+
+        try:
+            return access_levels[uid] == CollectionAccessLevel.ReadOnly
+        except KeyError as e:
+            raise DoesNotExist(e)
+
     def _collection_list_dirty_get(self):
         with db.database_proxy:
             return self.user.collections.where(models.CollectionEntity.dirty | models.CollectionEntity.new)
@@ -155,49 +535,76 @@ class Etebase:
                 col_mgr.upload(col, None)
 
                 collection.dirty = False
-                collection.save()
+                collection.save(only=[models.CollectionEntity.dirty])
 
-    def sync_collection(self, uid):
-        self.push_collection(uid)
-        self.pull_collection(uid)
+    def sync_collection(self, uid, writer=_call):
+        """Sync a single collection. Database writes are passed to writer as callables."""
+        self.push_collection(uid, writer)
+        self.pull_collection(uid, writer)
 
-    def pull_collection(self, uid):
+    def pull_collection(self, uid, writer=_call):
+        col_mgr = self.etebase.get_collection_manager()
         with db.database_proxy:
-            col_mgr = self.etebase.get_collection_manager()
             cache_col = models.CollectionEntity.get(local_user=self.user, uid=uid)
-            if cache_col.stoken == cache_col.local_stoken:
-                return
+        if cache_col.stoken == cache_col.local_stoken:
+            return
 
-            col = col_mgr.cache_load(cache_col.eb_col)
-            item_mgr = col_mgr.get_item_manager(col)
-            stoken = cache_col.local_stoken
-            done = False
-
-            while not done:
-                fetch_options = FetchOptions().stoken(stoken)
-                item_list = item_mgr.list(fetch_options)
+        col = col_mgr.cache_load(cache_col.eb_col)
+        item_mgr = col_mgr.get_item_manager(col)
+        stoken = cache_col.local_stoken
+        done = False
 
-                for item in item_list.data:
-                    meta = item.meta
-                    # Skip malformed entries
-                    if "name" not in meta:
-                        continue
+        while not done:
+            fetch_options = FetchOptions().stoken(stoken)
+            item_list = item_mgr.list(fetch_options)
+
+            items = []
+            for item in item_list.data:
+                meta = item.meta
+                # Skip malformed entries
+                if "name" not in meta:
+                    continue
+
+                items.append(
+                    dict(
+                        uid=meta["name"],
+                        eb_item=item_mgr.cache_save(item),
+                        deleted=item.deleted,
+                        **_item_columns(
+                            self.plaintext_cipher, meta["name"], item, meta.get("mtime"), col.collection_type
+                        ),
+                    )
+                )
 
-                    cache_item = models.ItemEntity.get_or_none(collection=cache_col, uid=meta["name"])
-                    if cache_item is None:
-                        cache_item = models.ItemEntity(
-                            collection=cache_col,
-                            uid=meta["name"],
-                        )
-                    cache_item.eb_item = item_mgr.cache_save(item)
-                    cache_item.deleted = item.deleted
-                    cache_item.save()
+            done = item_list.done
+            stoken = item_list.stoken
 
-                done = item_list.done
-                stoken = item_list.stoken
+            writer(functools.partial(self._save_pulled_items, cache_col, items, stoken))
 
-                cache_col.local_stoken = stoken
-                cache_col.save()
+    def _save_pulled_items(self, cache_col, items, stoken):
+        """Write a fetched page and the stoken it leads to in one transaction."""
+        CHUNK_UPSERT = 100
+        with db.database_proxy:
+            change_seq = _next_change_seq(cache_col.id)
+
+            rows = [dict(item, collection=cache_col.id, change_seq=change_seq) for item in items]
+            # Upsert against the (collection, uid) unique index, keeping the local flags of existing items
+            for chunk in batch(rows, CHUNK_UPSERT):
+                models.ItemEntity.insert_many(chunk).on_conflict(
+                    conflict_target=[models.ItemEntity.collection, models.ItemEntity.uid],
+                    preserve=[
+                        models.ItemEntity._meta.fields[name] for name in chunk[0] if name not in ("collection", "uid")
+                    ],
+                ).execute()
+
+            for item in items:
+                item_cache.invalidate(cache_col.uid, item["uid"])
+
+            cache_col.local_stoken = stoken
+            cache_col.change_seq = change_seq
+            # Only touch the stoken, the rest of the row may have been changed since we read it
+            cache_col.save(only=[models.CollectionEntity.local_stoken])
+            _record_sync_token(cache_col)
 
     def _collection_dirty_get(self, collection):
         with db.database_proxy:
@@ -209,46 +616,96 @@ class Etebase:
             changed = list(self._collection_dirty_get(cache_col))
             return len(changed) > 0
 
-    def push_collection(self, uid):
+    def push_collection(self, uid, writer=_call):
+        CHUNK_PUSH = 30
+        col_mgr = self.etebase.get_collection_manager()
         with db.database_proxy:
-            CHUNK_PUSH = 30
-            col_mgr = self.etebase.get_collection_manager()
             cache_col = models.CollectionEntity.get(local_user=self.user, uid=uid)
-            col = col_mgr.cache_load(cache_col.eb_col)
-            item_mgr = col_mgr.get_item_manager(col)
+            changed = list(self._collection_dirty_get(cache_col))
+        if len(changed) == 0:
+            return
+
+        col = col_mgr.cache_load(cache_col.eb_col)
+        item_mgr = col_mgr.get_item_manager(col)
 
-            changed = self._collection_dirty_get(cache_col)
+        for chunk in batch(changed, CHUNK_PUSH):
+            chunk_items = list(map(lambda x: item_mgr.cache_load(x.eb_item), chunk))
+            item_mgr.batch(chunk_items, None, None)
+            writer(functools.partial(self._save_pushed_items, item_mgr, chunk, chunk_items))
 
-            for chunk in batch(changed, CHUNK_PUSH):
-                chunk_items = list(map(lambda x: item_mgr.cache_load(x.eb_item), chunk))
-                item_mgr.batch(chunk_items, None, None)
-                for cache_item, item in zip(chunk, chunk_items):
-                    cache_item.eb_item = item_mgr.cache_save(item)
-                    cache_item.dirty = False
-                    cache_item.new = False
-                    cache_item.save()
+    def _save_pushed_items(self, item_mgr, chunk, chunk_items):
+        with db.database_proxy:
+            for cache_item, item in zip(chunk, chunk_items):
+                # Items changed locally while being pushed stay dirty so the newer version is pushed next time
+                models.ItemEntity.update(
+                    eb_item=item_mgr.cache_save(item), etag=item.etag, dirty=False, new=False
+                ).where(
+                    (models.ItemEntity.id == cache_item.id) & (models.ItemEntity.change_seq == cache_item.change_seq)
+                ).execute()
+
+    def _load_col(self, col_mgr, cache_col):
+        """Load the collection object, reusing the last loaded one if the collection hasn't changed since."""
+        with self._loaded_cols_lock:
+            loaded = self._loaded_cols.get(cache_col.uid)
+        # Local changes (e.g. to the meta) don't change the stoken, but do change the serialized collection
+        if loaded is not None and loaded[0] == cache_col.stoken and loaded[1] == cache_col.eb_col:
+            return loaded[2]
+
+        col = col_mgr.cache_load(cache_col.eb_col)
+        with self._loaded_cols_lock:
+            self._loaded_cols[cache_col.uid] = (cache_col.stoken, cache_col.eb_col, col)
+        return col
 
     # CRUD operations
     def list(self):
         with db.database_proxy:
             col_mgr = self.etebase.get_collection_manager()
             for cache_obj in self.user.collections.where(~models.CollectionEntity.deleted):
-                yield Collection(col_mgr, cache_obj)
+                yield Collection(col_mgr, cache_obj, self.plaintext_cipher, self._load_col(col_mgr, cache_obj))
 
     def get(self, uid):
         with db.database_proxy:
             col_mgr = self.etebase.get_collection_manager()
             try:
-                return Collection(
-                    col_mgr,
-                    self.user.collections.where(
-                        (models.CollectionEntity.uid == uid) & ~models.CollectionEntity.deleted
-                    ).get(),
-                )
+                cache_obj = self.user.collections.where(
+                    (models.CollectionEntity.uid == uid) & ~models.CollectionEntity.deleted
+                ).get()
             except models.CollectionEntity.DoesNotExist as e:
                 raise DoesNotExist(e)
 
+            return Collection(col_mgr, cache_obj, self.plaintext_cipher, self._load_col(col_mgr, cache_obj))
+
     def clear_user(self):
+        """Remove the user's cache. The user's sync must have been stopped, and the instance can't be used anymore
+        after."""
+        with self._access_levels_lock:
+            self._access_levels = None
+        with self._loaded_cols_lock:
+            self._loaded_cols = {}
+        # Don't keep the user's decrypted items in memory. The cache can't tell whose entries are whose, as it's shared
+        # between users, but everyone else's are just prepared again when needed.
+        item_cache.clear()
+
+        if config.ETEBASE_DATABASE_PER_USER:
+            # All of the data is in the user's own file, so just remove it
+            db_path = self._database.database
+            with _databases_lock:
+                _databases.pop(db_path, None)
+            self._cleared = True
+            self._database.close_all()
+            self.user = None
+            errors = []
+            for suffix in ("", "-wal", "-shm"):
+                try:
+                    os.remove(db_path + suffix)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    errors.append(e)
+            if errors:
+                raise StorageException("Failed removing the cache of user {}: {}".format(self.username, errors[0]))
+            return
+
         with db.database_proxy:
             for col in self.user.collections:
                 for item in col.items:
@@ -256,13 +713,15 @@ class Etebase:
                 col.delete_instance()
             self.user.delete_instance()
             self.user = None
+        self._cleared = True
 
 
 class Collection:
-    def __init__(self, col_mgr, cache_col):
+    def __init__(self, col_mgr, cache_col, plaintext_cipher=None, col=None):
         self.col_mgr = col_mgr
         self.cache_col = cache_col
-        self.col = col_mgr.cache_load(cache_col.eb_col)
+        self.plaintext_cipher = plaintext_cipher
+        self.col = col if col is not None else col_mgr.cache_load(cache_col.eb_col)
 
     @property
     def uid(self):
@@ -280,6 +739,77 @@ class Collection:
     def col_type(self):
         return self.col.collection_type
 
+    def record_sync_token(self):
+        """Make the current stoken usable with ``changed_since``."""
+        if self.cache_col.local_stoken is None:
+            return
+
+        with db.database_proxy:
+            # Pulls record every stoken they reach, so only ones from before stokens were recorded are missing.
+            # Checked first so serving a sync doesn't take the write lock.
+            recorded = self.cache_col.sync_tokens.where(
+                models.SyncTokenEntity.stoken == self.cache_col.local_stoken
+            ).exists()
+            if not recorded:
+                models.SyncTokenEntity.insert(
+                    collection=self.cache_col, stoken=self.cache_col.local_stoken, change_seq=self.cache_col.change_seq
+                ).on_conflict_ignore().execute()
+
+    def changed_since(self, stoken, make_href):
+        """List the hrefs of the items (including deleted ones) changed since the collection was at ``stoken``.
+
+        Items without an href are mapped using ``make_href(uid)``, with the uid of the Etebase item.
+        """
+        with db.database_proxy:
+            sync_token = self.cache_col.sync_tokens.where(models.SyncTokenEntity.stoken == stoken).first()
+            if sync_token is None:
+                raise DoesNotExist("Unknown stoken: {}".format(stoken))
+
+            return self._list_hrefs(models.ItemEntity.change_seq > sync_token.change_seq, make_href)
+
+    def _list_hrefs(self, where, make_href):
+        with db.database_proxy:
+            query = (
+                models.ItemEntity.select(models.ItemEntity.id, models.ItemEntity.deleted, models.HrefMapper.href)
+                .join(
+                    models.HrefMapper,
+                    pw.JOIN.LEFT_OUTER,
+                    on=(models.HrefMapper.content == models.ItemEntity.id),
+                )
+                .where((models.ItemEntity.collection == self.cache_col) & where)
+                .tuples()
+            )
+
+            hrefs = []
+            missing = {}
+            for item_id, deleted, href in query:
+                if href is None:
+                    if deleted:
+                        # Never had an href, so clients have never seen it
+                        continue
+                    missing[item_id] = len(hrefs)
+                hrefs.append(href)
+
+            if not missing:
+                return hrefs
+
+            # Named after the uid of the Etebase item, so only the items without an href are loaded
+            item_mgr = self.col_mgr.get_item_manager(self.col)
+            mappers = []
+            for chunk in batch(list(missing), 100):
+                query = models.ItemEntity.select(models.ItemEntity.id, models.ItemEntity.eb_item).where(
+                    models.ItemEntity.id.in_(chunk)
+                )
+                for item_id, eb_item in query.tuples():
+                    href = make_href(item_mgr.cache_load(eb_item).uid)
+                    hrefs[missing[item_id]] = href
+                    mappers.append({"content": item_id, "href": href})
+
+            for chunk in batch(mappers, 100):
+                models.HrefMapper.insert_many(chunk).execute()
+
+            return hrefs
+
     @property
     def meta(self):
         return self.col.meta
@@ -287,11 +817,20 @@ class Collection:
     def update_meta(self, update_info):
         if update_info is None:
             raise RuntimeError("update_info can't be None.")
-        meta = self.meta
+        meta = dict(self.meta)
+        if all(key in meta and meta[key] == value for key, value in update_info.items()):
+            # Nothing to change, so don't write
+            return
         meta.update(update_info)
-        self.col.meta = meta
-        self.cache_col.eb_col = self.col_mgr.cache_save(self.col)
-        self.cache_col.save()
+        # Changed on a copy, as the loaded collection is shared with other requests and must keep matching what's
+        # stored if saving fails
+        col = self.col_mgr.cache_load(self.cache_col.eb_col)
+        col.meta = meta
+        self.cache_col.eb_col = self.col_mgr.cache_save(col)
+        with db.database_proxy:
+            # The object may be older than the row, so don't put back e.g. an older local_stoken and change_seq
+            self.cache_col.save(only=[models.CollectionEntity.eb_col])
+        self.col = col
 
     # CRUD
     def create(self, vobject_item):
@@ -303,7 +842,7 @@ class Collection:
             cache_item.eb_item = item_mgr.cache_save(item)
             cache_item.deleted = item.deleted
             cache_item.new = True
-            return Item(item_mgr, cache_item)
+            return Item(item_mgr, cache_item, self.plaintext_cipher, self.col_type)
 
     def get(self, uid):
         with db.database_proxy:
@@ -312,6 +851,8 @@ class Collection:
                 return Item(
                     item_mgr,
                     self.cache_col.items.where((models.ItemEntity.uid == uid) & ~models.ItemEntity.deleted).get(),
+                    self.plaintext_cipher,
+                    self.col_type,
                 )
             except models.ItemEntity.DoesNotExist:
                 return None
@@ -320,20 +861,71 @@ class Collection:
         with db.database_proxy:
             item_mgr = self.col_mgr.get_item_manager(self.col)
             for cache_item in self.cache_col.items.where(~models.ItemEntity.deleted):
-                yield Item(item_mgr, cache_item)
+                yield Item(item_mgr, cache_item, self.plaintext_cipher, self.col_type)
+
+    def has_uid(self, uid):
+        with db.database_proxy:
+            return self.cache_col.items.where((models.ItemEntity.uid == uid) & ~models.ItemEntity.deleted).exists()
+
+    def list_hrefs(self, make_href):
+        """List the hrefs of all of the items. Items without an href are mapped using ``make_href(uid)``, with the uid
+        of the Etebase item."""
+        return self._list_hrefs(~models.ItemEntity.deleted, make_href)
+
+    def list_hrefs_in_range(self, component_name, start, end, make_href):
+        """Like ``list_hrefs``, but only for items that may be ``component_name`` (any if None) and overlap the time
+        range. Items that were not indexed are always included."""
+        where = ~models.ItemEntity.deleted
+        if component_name is not None:
+            where &= models.ItemEntity.component_name.is_null() | (models.ItemEntity.component_name == component_name)
+        where &= models.ItemEntity.time_start.is_null() | (
+            (models.ItemEntity.time_start < end) & (models.ItemEntity.time_end > start)
+        )
+        return self._list_hrefs(where, make_href)
+
+    def get_by_hrefs(self, hrefs):
+        """Fetch the items mapped to ``hrefs``. Yields (href, item) tuples only for the items found."""
+        CHUNK_HREFS = 500
+        with db.database_proxy:
+            item_mgr = self.col_mgr.get_item_manager(self.col)
+            for chunk in batch(list(hrefs), CHUNK_HREFS):
+                query = (
+                    models.ItemEntity.select(models.ItemEntity, models.HrefMapper)
+                    .join(
+                        models.HrefMapper,
+                        on=(models.HrefMapper.content == models.ItemEntity.id),
+                        attr="href_mapper",
+                    )
+                    .where(
+                        (models.ItemEntity.collection == self.cache_col)
+                        & ~models.ItemEntity.deleted
+                        & models.HrefMapper.href.in_(chunk)
+                    )
+                )
+                for cache_item in query:
+                    yield cache_item.href_mapper.href, Item(item_mgr, cache_item, self.plaintext_cipher, self.col_type)
 
 
 class Item:
-    def __init__(self, item_mgr, cache_item):
+    def __init__(self, item_mgr, cache_item, plaintext_cipher=None, col_type=None):
         self.item_mgr = item_mgr
         self.cache_item = cache_item
-        self.item = item_mgr.cache_load(cache_item.eb_item)
+        self.plaintext_cipher = plaintext_cipher
+        self.col_type = col_type
+        self._item = None
+
+    @property
+    def item(self):
+        # Only loaded when needed, as most reads are answered from the cached columns
+        if self._item is None:
+            self._item = self.item_mgr.cache_load(self.cache_item.eb_item)
+        return self._item
 
     @property
     def uid(self):
-        return self.meta["name"]
+        # Items are named after their uid when created
+        return self.cache_item.uid
 
-    # FIXME: cache
     @property
     def meta(self):
         return self.item.meta
@@ -342,15 +934,27 @@ class Item:
     def meta(self, meta):
         self.item.meta = meta
 
-    # FIXME: cache
     @property
     def content(self):
+        if self._item is None and self.cache_item.content is not None and self.plaintext_cipher is not None:
+            content = self.plaintext_cipher.decrypt(self.cache_item.uid, self.cache_item.content)
+            if content is not None:
+                return content.decode()
         return self.item.content.decode()
 
     @property
     def etag(self):
+        if self._item is None and self.cache_item.etag is not None:
+            return self.cache_item.etag
         return self.item.etag
 
+    @property
+    def mtime(self):
+        """The modification time in milliseconds, or None if unknown."""
+        if self._item is None and self.cache_item.mtime is not None:
+            return self.cache_item.mtime
+        return self.item.meta.get("mtime")
+
     @content.setter
     def content(self, content):
         self.item.content = content.encode()
@@ -366,5 +970,12 @@ class Item:
         self.meta = item_meta
         with db.database_proxy:
             self.cache_item.eb_item = self.item_mgr.cache_save(self.item)
+            columns = _item_columns(
+                self.plaintext_cipher, self.cache_item.uid, self.item, item_meta["mtime"], self.col_type
+            )
+            for name, value in columns.items():
+                setattr(self.cache_item, name, value)
             self.cache_item.dirty = True
+            self.cache_item.change_seq = _next_change_seq(self.cache_item.collection_id)
             self.cache_item.save()
+            item_cache.invalidate(self.cache_item.collection.uid, self.cache_item.uid)
@@ -1,6 +1,74 @@
+import sqlite3
+import threading
+import weakref
+
 import peewee as pw
+from playhouse.sqlite_ext import SqliteExtDatabase
+
+
+class ThreadLocalProxy(pw.DatabaseProxy):
+    """A database proxy that is initialized separately for each thread.
+
+    Every Etebase instance binds its own database in the threads it's used from, so different users and the sync
+    threads don't clobber each other's database.
+    """
+
+    def __init__(self):
+        object.__setattr__(self, "_local", threading.local())
+        super().__init__()
+
+    @property
+    def obj(self):
+        return getattr(self._local, "obj", None)
+
+    @obj.setter
+    def obj(self, value):
+        self._local.obj = value
+
+    def __setattr__(self, attr, value):
+        object.__setattr__(self, attr, value)
+
+
+class _Connection(sqlite3.Connection):
+    # Unlike sqlite3.Connection, supports weak references
+    pass
+
+
+class TrackingDatabase(SqliteExtDatabase):
+    """A database keeping track of the connections of all threads, so they can all be closed at once.
+
+    Needed before removing the file, as open connections keep it in use (and on Windows prevent removing it).
+    Connections are only weakly referenced, so those of exited threads are still closed when collected.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._connections = weakref.WeakSet()
+        self._connections_lock = threading.Lock()
+        # Closing the connections of other threads is only safe while they don't use them
+        super().__init__(*args, check_same_thread=False, factory=_Connection, **kwargs)
+
+    def _connect(self):
+        conn = super()._connect()
+        with self._connections_lock:
+            self._connections.add(conn)
+        return conn
+
+    def _close(self, conn):
+        with self._connections_lock:
+            self._connections.discard(conn)
+        super()._close(conn)
+
+    def close_all(self):
+        """Close the connections of all threads, which must not be using them."""
+        self.close()
+        with self._connections_lock:
+            connections = list(self._connections)
+            self._connections.clear()
+        for conn in connections:
+            conn.close()
+
 
-database_proxy = pw.Proxy()
+database_proxy = ThreadLocalProxy()
 
 
 class BaseModel(pw.Model):
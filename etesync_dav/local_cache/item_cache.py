@@ -0,0 +1,61 @@
+import threading
+from collections import OrderedDict
+
+
+class ItemCache:
+    """A bounded, least-recently-used cache of data derived from items (e.g. decrypted and parsed content).
+
+    Entries are keyed by the collection uid, item uid and variant (e.g. the vCard version served), and are only
+    returned for a matching etag, so changed items never hit stale entries. Invalidating is only needed for freeing
+    memory early.
+    """
+
+    # Rough memory used by an entry on top of its own size
+    ENTRY_OVERHEAD = 512
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._variants = {None}
+        self._lock = threading.Lock()
+
+    def get(self, col_uid, item_uid, etag, variant=None):
+        key = (col_uid, item_uid, variant)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != etag:
+                return None
+
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, col_uid, item_uid, etag, value, size, variant=None):
+        key = (col_uid, item_uid, variant)
+        size += self.ENTRY_OVERHEAD
+        with self._lock:
+            self._variants.add(variant)
+            self._pop(key)
+            if size > self.max_size:
+                return
+
+            self._entries[key] = (etag, value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def invalidate(self, col_uid, item_uid):
+        with self._lock:
+            for variant in self._variants:
+                self._pop((col_uid, item_uid, variant))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
@@ -22,6 +22,8 @@ class CollectionEntity(db.BaseModel):
     deleted = pw.BooleanField(null=False, default=False)
     stoken = pw.CharField(null=True, default=None)
     local_stoken = pw.CharField(null=True, default=None)
+    # The last change sequence number given to an item of the collection
+    change_seq = pw.IntegerField(null=False, default=0)
 
     class Meta:
         indexes = ((("local_user", "uid"), True),)
@@ -35,11 +37,36 @@ class ItemEntity(db.BaseModel):
     new = pw.BooleanField(null=False, default=False)
     dirty = pw.BooleanField(null=False, default=False)
     deleted = pw.BooleanField(null=False, default=False)
+    # The collection's change sequence number when the item was last changed
+    change_seq = pw.IntegerField(null=False, default=0)
+    # Copied from the Etebase item so they can be read without loading it
+    etag = pw.CharField(null=True, default=None)
+    mtime = pw.IntegerField(null=True, default=None)
+    # The compressed and encrypted content, only when ETEBASE_CACHE_PLAINTEXT is set (see plaintext.py)
+    content = pw.BlobField(null=True, default=None)
+    # For pre-filtering calendar queries: the component and the time range it covers, including recurrences
+    component_name = pw.CharField(null=True, default=None)
+    time_start = pw.BigIntegerField(null=True, default=None)
+    time_end = pw.BigIntegerField(null=True, default=None)
 
     class Meta:
-        indexes = ((("collection", "uid"), True),)
+        indexes = (
+            (("collection", "uid"), True),
+            (("collection", "change_seq"), False),
+            (("collection", "time_end"), False),
+        )
 
 
 class HrefMapper(db.BaseModel):
     content = pw.ForeignKeyField(ItemEntity, primary_key=True, backref="href", on_delete="CASCADE")
     href = pw.CharField(null=False, index=True)
+
+
+class SyncTokenEntity(db.BaseModel):
+    collection = pw.ForeignKeyField(CollectionEntity, backref="sync_tokens", on_delete="CASCADE")
+    # A local_stoken the collection was at, and the collection's change_seq at that point
+    stoken = pw.CharField(null=False)
+    change_seq = pw.IntegerField(null=False)
+
+    class Meta:
+        indexes = ((("collection", "stoken"), True),)
@@ -0,0 +1,36 @@
+import os
+import zlib
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+NONCE_SIZE = 12
+
+
+class PlaintextCipher:
+    """Protects the item content we keep next to the Etebase items, so reading it doesn't need Etebase's decryption.
+
+    The key is derived from the user's stored session, which is already stored on the same machine, so this is as
+    safe at rest as the session itself. The item's uid is authenticated with the content so blobs can't be swapped.
+    """
+
+    def __init__(self, stored_session):
+        if isinstance(stored_session, str):
+            stored_session = stored_session.encode()
+        key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"etesync-dav item content").derive(
+            stored_session
+        )
+        self._aead = ChaCha20Poly1305(key)
+
+    def encrypt(self, uid, content):
+        nonce = os.urandom(NONCE_SIZE)
+        return nonce + self._aead.encrypt(nonce, zlib.compress(content), uid.encode())
+
+    def decrypt(self, uid, blob):
+        """Return the content, or None if it can't be decrypted (e.g. it was encrypted for an older session)."""
+        try:
+            return zlib.decompress(self._aead.decrypt(blob[:NONCE_SIZE], blob[NONCE_SIZE:], uid.encode()))
+        except InvalidTag:
+            return None
@@ -25,7 +25,7 @@ from etesync_dav.config import CREDS_FILE, DATA_DIR, ETESYNC_URL, HTPASSWD_FILE,
 
 from . import local_cache
 from .radicale.creds import Credentials
-from .radicale.etesync_cache import etesync_for_user
+from .radicale.etesync_cache import etesync_for_user, user_lock
 
 
 class Htpasswd:
@@ -216,6 +216,14 @@ class Manager:
 
         try:
             with etesync_for_user(username) as (etesync, _):
+                sync_thread = getattr(etesync, "sync_thread", None)
+            if sync_thread is not None:
+                # Must not write to the cache while or after removing it. Not holding the user's lock, as the sync
+                # takes it when starting.
+                sync_thread.stop()
+
+            # No requests of the user while removing
+            with user_lock(username), etesync_for_user(username) as (etesync, _):
                 if hasattr(etesync, "clear_user"):
                     etesync.clear_user()
                 else:
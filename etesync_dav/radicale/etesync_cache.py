@@ -14,6 +14,7 @@
 
 import os
 import threading
+import time
 from contextlib import contextmanager
 
 import etesync as api
@@ -30,22 +31,50 @@ class EteSync(api.EteSync):
         super()._init_db_tables(database, additional_tables + [HrefMapper])
 
 
+# Minimum time, in seconds, between checks of whether the credentials file changed
+CREDS_RELOAD_INTERVAL = 1
+
+
 class EteSyncCache:
     def __init__(self, creds_path, db_path):
         self._etesync_cache = {}
+        self._user_locks = {}
+        self._user_locks_lock = threading.Lock()
+        # All of the legacy users share a database, so only one of them may initialize it at a time
+        self._legacy_db_lock = threading.Lock()
+        self._creds_lock = threading.Lock()
+        self._creds_loaded = None
         self.creds = None
         self.creds_path = os.path.expanduser(creds_path)
         self.db_path = os.path.expanduser(db_path)
 
+    def user_lock(self, user):
+        with self._user_locks_lock:
+            return self._user_locks.setdefault(user, threading.RLock())
+
+    def _load_creds(self, force):
+        with self._creds_lock:
+            now = time.monotonic()
+            if self.creds is None:
+                self.creds = Credentials(self.creds_path)
+            elif force or now - self._creds_loaded >= CREDS_RELOAD_INTERVAL:
+                self.creds.load()
+            else:
+                return
+            self._creds_loaded = now
+
     def etesync_for_user(self, user):
-        if self.creds:
-            # Always attempt a reload
-            self.creds.load()
+        # Only requests for the same user wait on each other
+        with self.user_lock(user):
+            # Always reload for users we don't know yet, they may have just been added
+            self._load_creds(force=user not in self._etesync_cache)
 
             # Used the cached etesync for the user unless the cipher_key or auth_token have changed.
             if user in self._etesync_cache:
                 etesync = self._etesync_cache[user]
                 if isinstance(etesync, Etebase) and (etesync.stored_session == self.creds.get_etebase(user)):
+                    # The calling thread may have last used another user's database
+                    etesync.bind()
                     return etesync, False
                 elif isinstance(etesync, EteSync) and (
                     (etesync.auth_token, etesync.cipher_key) == self.creds.get(user)
@@ -53,29 +82,28 @@ class EteSyncCache:
                     return etesync, False
                 else:
                     del self._etesync_cache[user]
-        else:
-            self.creds = Credentials(self.creds_path)
 
-        remote_url = self.creds.get_server_url(user)
-        stored_session = self.creds.get_etebase(user)
-        if stored_session is not None:
-            etesync = Etebase(user, stored_session, remote_url)
-        else:
-            auth_token, cipher_key = self.creds.get(user)
+            remote_url = self.creds.get_server_url(user)
+            stored_session = self.creds.get_etebase(user)
+            if stored_session is not None:
+                etesync = Etebase(user, stored_session, remote_url)
+            else:
+                auth_token, cipher_key = self.creds.get(user)
 
-            db_name_unique = "generic"
+                db_name_unique = "generic"
 
-            db_path = self.db_path.format(db_name_unique)
+                db_path = self.db_path.format(db_name_unique)
 
-            if auth_token is None:
-                raise Exception('Very bad! User "{}" not found in credentials file.'.format(user))
+                if auth_token is None:
+                    raise Exception('Very bad! User "{}" not found in credentials file.'.format(user))
 
-            etesync = EteSync(user, auth_token, remote=remote_url, db_path=db_path)
-            etesync.cipher_key = cipher_key
+                with self._legacy_db_lock:
+                    etesync = EteSync(user, auth_token, remote=remote_url, db_path=db_path)
+                etesync.cipher_key = cipher_key
 
-        self._etesync_cache[user] = etesync
+            self._etesync_cache[user] = etesync
 
-        return etesync, True
+            return etesync, True
 
 
 _etesync_cache = EteSyncCache(
@@ -84,12 +112,13 @@ _etesync_cache = EteSyncCache(
 )
 
 
-_get_etesync_lock = threading.RLock()
+def user_lock(user):
+    """A lock for serializing a user's requests, without blocking other users."""
+    return _etesync_cache.user_lock(user)
 
 
 @contextmanager
 def etesync_for_user(user):
-    with _get_etesync_lock:
-        ret = _etesync_cache.etesync_for_user(user)
+    ret = _etesync_cache.etesync_for_user(user)
 
     yield ret
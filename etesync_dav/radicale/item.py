@@ -0,0 +1,177 @@
+# Copyright © 2017 Tom Hacohen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import functools
+import sys
+
+import vobject
+from radicale.item import Item
+
+from ..local_cache import item_cache
+from . import vcard
+
+# Added to the (quoted) etags of vCards served as is, to tell them apart from the converted ones
+VERBATIM_ETAG_SUFFIX = "-vcard4"
+
+
+class EteSyncItem(Item):
+    def __init__(self, *args, **kwargs):
+        """Initialize an item.
+
+        ``collection_path`` the path of the parent collection (optional if
+        ``collection`` is set).
+
+        ``collection`` the parent collection (optional).
+
+        ``href`` the href of the item.
+
+        ``last_modified`` the HTTP-datetime of when the item was modified.
+
+        ``text`` the text representation of the item (optional if
+        ``vobject_item`` is set).
+
+        ``vobject_item`` the vobject item (optional if ``text`` is set).
+
+        ``etag`` the etag of the item (optional). See ``get_etag``.
+
+        ``uid`` the UID of the object (optional). See ``get_uid_from_object``.
+
+        ``name`` the name of the item (optional). See ``vobject_item.name``.
+
+        ``component_name`` the name of the primary component (optional).
+        See ``find_tag``.
+
+        ``time_range`` the enclosing time range.
+        See ``find_tag_and_time_range``.
+
+        ``etesync_item`` the item of the backend.
+
+        ``loader`` a function returning the vobject item or the text, used
+        instead of ``text`` and ``vobject_item`` to only decrypt and parse the
+        item when needed (optional).
+
+        """
+        self.etesync_item = kwargs.pop("etesync_item")
+        self._loader = kwargs.pop("loader", None)
+        if self._loader is not None:
+            # Radicale requires either text or vobject_item, the real ones are set when loading
+            kwargs["text"] = ""
+        super().__init__(*args, **kwargs)
+        if self._loader is not None:
+            self._text = None
+
+    def _load(self):
+        if self._loader is not None:
+            loader = self._loader
+            self._loader = None
+            loaded = loader()
+            if isinstance(loaded, str):
+                self._text = loaded
+            else:
+                self._vobject_item = loaded
+
+    @property
+    def vobject_item(self):
+        self._load()
+        return super().vobject_item
+
+    def serialize(self):
+        self._load()
+        return super().serialize()
+
+
+class LazyItemsMixIn:
+    """Make the items of a collection, only decrypting and parsing their content when needed.
+
+    What's needed for answering requests is cached by etag, so it's only prepared once. Requires the ``uid``,
+    ``path`` and ``item_name`` attributes of the collections of both backends.
+
+    """
+
+    # Whether to add an FN to vCards missing it when converting them to 3.0
+    vcard3_add_missing_fn = False
+
+    def _make_lazy_item(self, href, etesync_item, uid, etag, last_modified, indexed):
+        """Make the item, with ``indexed`` the item's arguments that are known without loading it."""
+        # Clients supporting vCard 4.0 get the content as is, so it's cached separately from the converted one
+        verbatim = self.item_name == "VCARD" and vcard.native_vcard4.get()
+        variant = "verbatim" if verbatim else None
+        if verbatim:
+            # A different representation must not share the etag (RFC 7232), this also makes clients that only
+            # now get it as is fetch it again
+            etag = etag[:-1] + VERBATIM_ETAG_SUFFIX + '"'
+
+        prepared = item_cache.get(self.uid, uid, etag, variant)
+        if prepared is not None:
+            return EteSyncItem(
+                collection=self,
+                href=href,
+                last_modified=last_modified,
+                etesync_item=etesync_item,
+                etag=etag,
+                **prepared,
+            )
+
+        if verbatim:
+            loader = functools.partial(self._load_content, etesync_item, uid, etag, indexed)
+        else:
+            loader = functools.partial(self._load_item, href, etesync_item, uid, etag)
+        return EteSyncItem(
+            collection=self,
+            href=href,
+            last_modified=last_modified,
+            etesync_item=etesync_item,
+            etag=etag,
+            loader=loader,
+            **indexed,
+        )
+
+    def _load_content(self, etesync_item, uid, etag, indexed):
+        # Neither parsed nor converted, whatever isn't indexed is only computed by radicale when needed
+        content = etesync_item.content
+        prepared = dict(indexed, text=content)
+        item_cache.set(self.uid, uid, etag, prepared, sys.getsizeof(content), variant="verbatim")
+
+        return content
+
+    def _load_item(self, href, etesync_item, uid, etag):
+        try:
+            content = etesync_item.content
+            if self.item_name == "VCARD":
+                # XXX Hack: fake transform 4.0 vCards to 3.0 for clients that don't support 4.0
+                content = vcard.to_vcard3(content, add_missing_fn=self.vcard3_add_missing_fn)
+            item = vobject.readOne(content)
+        except Exception as e:
+            raise RuntimeError("Failed to parse item %r in %r" % (href, self.path)) from e
+
+        ret = EteSyncItem(collection=self, vobject_item=item, href=href, etesync_item=etesync_item, etag=etag)
+
+        # Cache what's needed for answering requests without decrypting and parsing again. The vobject item itself
+        # isn't cached, as radicale may modify it in place (e.g. when expanding recurrences).
+        try:
+            ret.prepare()
+        except Exception:
+            # Still serve items we can't fully process, just don't cache them
+            return item
+
+        prepared = {
+            "text": ret.serialize(),
+            "uid": ret.uid,
+            "name": ret.name,
+            "component_name": ret.component_name,
+            "time_range": ret.time_range,
+        }
+        item_cache.set(self.uid, uid, etag, prepared, sys.getsizeof(prepared["text"]))
+
+        return item
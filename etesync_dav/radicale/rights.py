@@ -15,6 +15,7 @@
 import etesync as api
 from radicale import pathutils, rights
 
+from ..local_cache import DoesNotExist, Etebase
 from .etesync_cache import etesync_for_user
 
 
@@ -39,10 +40,14 @@ class Rights(rights.BaseRights):
 
             with etesync_for_user(user) as (etesync, _):
                 try:
-                    journal = etesync.get(journal_uid)
-                except api.exceptions.DoesNotExist:
+                    if isinstance(etesync, Etebase):
+                        # Checked on every request, so only look up the cached access level
+                        read_only = etesync.is_read_only(journal_uid)
+                    else:
+                        read_only = etesync.get(journal_uid).read_only
+                except (api.exceptions.DoesNotExist, DoesNotExist):
                     return ""
 
-            return "rw" if not journal.read_only else "r"
+            return "rw" if not read_only else "r"
 
         return ""
@@ -15,24 +15,25 @@
 import hashlib
 import logging
 import posixpath
-import re
 import threading
 import time
 from contextlib import contextmanager
 
 import etesync as api
-import vobject
 from radicale import pathutils
-from radicale.item import Item, get_etag
+from radicale.item import get_etag
 from radicale.storage import (
     BaseCollection,
     BaseStorage,
     ComponentNotFoundError,
 )
 
-from ..local_cache import COL_TYPES, Etebase
-from .etesync_cache import etesync_for_user
+from etesync_dav import config
+
+from ..local_cache import COL_TYPES, DoesNotExist, Etebase
+from .etesync_cache import etesync_for_user, user_lock
 from .href_mapper import HrefMapper
+from .item import LazyItemsMixIn
 from .storage_etebase_collection import Collection as EtebaseCollection
 
 logger = logging.getLogger("etesync-dav")
@@ -40,6 +41,8 @@ logger = logging.getLogger("etesync-dav")
 
 # How often we should sync automatically, in seconds
 SYNC_INTERVAL = 15 * 60
+# How often we should sync while collections keep changing, the interval then doubles up to config.SYNC_INTERVAL_IDLE
+SYNC_INTERVAL_ACTIVE = 60
 # Minimum time to wait between syncs
 SYNC_MINIMUM = 30
 
@@ -50,14 +53,26 @@ class SyncThread(threading.Thread):
         self._force_sync = threading.Event()
         self._done_syncing = threading.Event()
         self._done_syncing.set()  # We are done before we start.
+        self._synced_once = threading.Event()
+        self._stopped = threading.Event()
         self.user = user
         self.last_sync = None
+        self.interval = SYNC_INTERVAL
         self._exception = None
 
     def force_sync(self):
+        if self._stopped.is_set():
+            return
         self._force_sync.set()
         self._done_syncing.clear()
 
+    def stop(self):
+        """Stop syncing, waits for a running sync to finish."""
+        self._stopped.set()
+        # Wake it up if it's waiting for the next sync
+        self._force_sync.set()
+        self.join()
+
     def request_sync(self):
         if self.last_sync and time.time() - self.last_sync >= SYNC_MINIMUM:
             self.force_sync()
@@ -66,6 +81,10 @@ class SyncThread(threading.Thread):
     def forced_sync(self):
         return self._force_sync.is_set()
 
+    @property
+    def synced_once(self):
+        return self._synced_once.is_set()
+
     def wait_for_sync(self, timeout=None):
         ret = self._done_syncing.wait(timeout)
         e = self._exception
@@ -74,14 +93,23 @@ class SyncThread(threading.Thread):
             raise e
         return ret
 
+    def _next_interval(self, changed):
+        # The legacy backend doesn't tell us whether anything changed
+        if changed is None:
+            return SYNC_INTERVAL
+        elif changed:
+            return SYNC_INTERVAL_ACTIVE
+        return min(self.interval * 2, config.SYNC_INTERVAL_IDLE)
+
     def run(self):
-        while True:
+        while not self._stopped.is_set():
+            changed = False
             try:
                 with etesync_for_user(self.user) as (etesync, _):
                     self.last_sync = time.time()
                     self._done_syncing.clear()
 
-                    etesync.sync()
+                    changed = etesync.sync()
             except Exception as e:
                 # Print errors but keep on syncing in the background
                 logger.exception(e)
@@ -89,8 +117,11 @@ class SyncThread(threading.Thread):
             finally:
                 self._force_sync.clear()
                 self._done_syncing.set()
+                self._synced_once.set()
 
-            self._force_sync.wait(SYNC_INTERVAL)
+            self.interval = self._next_interval(changed)
+            if not self._stopped.is_set():
+                self._force_sync.wait(self.interval)
 
 
 class MetaMapping:
@@ -99,6 +130,13 @@ class MetaMapping:
         "D:displayname": ("displayName", None, None),
     }
 
+    # The type of the collection, served as the "tag" meta without being stored
+    tag = None
+
+    def virtual_meta(self):
+        """The meta that is derived from the collection rather than stored in it."""
+        return {"tag": self.tag}
+
     @classmethod
     def _reverse_mapping(cls, mappings):
         mappings.update({i[1][0]: (i[0], i[1][1], i[1][2]) for i in mappings.items()})
@@ -155,6 +193,7 @@ def IntToRgb(color):
 
 
 class MetaMappingCalendar(MetaMapping):
+    tag = "VCALENDAR"
     supported_calendar_component = "VEVENT"
     _mappings = MetaMapping._mappings.copy()
     _mappings.update(
@@ -171,6 +210,7 @@ class MetaMappingTaskList(MetaMappingCalendar):
 
 
 class MetaMappingContacts(MetaMapping):
+    tag = "VADDRESSBOOK"
     _mappings = MetaMapping._mappings.copy()
     _mappings.update(
         {
@@ -208,51 +248,9 @@ def _get_attributes_from_path(path):
     return attributes
 
 
-VCARD_4_TO_3_PHOTO_URI_REGEX = re.compile(r"^(PHOTO|LOGO):http", re.MULTILINE)
-VCARD_4_TO_3_PHOTO_INLINE_REGEX = re.compile(r"^(PHOTO|LOGO):data:image/([^;]*);base64,", re.MULTILINE)
-
-
-class EteSyncItem(Item):
-    def __init__(self, *args, **kwargs):
-        """Initialize an item.
-
-        ``collection_path`` the path of the parent collection (optional if
-        ``collection`` is set).
-
-        ``collection`` the parent collection (optional).
-
-        ``href`` the href of the item.
-
-        ``last_modified`` the HTTP-datetime of when the item was modified.
-
-        ``text`` the text representation of the item (optional if
-        ``vobject_item`` is set).
-
-        ``vobject_item`` the vobject item (optional if ``text`` is set).
-
-        ``etag`` the etag of the item (optional). See ``get_etag``.
-
-        ``uid`` the UID of the object (optional). See ``get_uid_from_object``.
-
-        ``name`` the name of the item (optional). See ``vobject_item.name``.
-
-        ``component_name`` the name of the primary component (optional).
-        See ``find_tag``.
-
-        ``time_range`` the enclosing time range.
-        See ``find_tag_and_time_range``.
+class Collection(LazyItemsMixIn, BaseCollection):
+    vcard3_add_missing_fn = True
 
-        """
-        self.etesync_item = kwargs.pop("etesync_item")
-        super().__init__(*args, **kwargs)
-
-    @property
-    def etag(self):
-        """Encoded as quoted-string (see RFC 2616)."""
-        return get_etag(self.vobject_item.serialize())
-
-
-class Collection(BaseCollection):
     def __init__(self, storage_, path):
         self._storage = storage_
         # Path should already be sanitized
@@ -267,16 +265,19 @@ class Collection(BaseCollection):
             self.collection = self.journal.collection
             if isinstance(self.collection, api.Calendar):
                 self.meta_mappings = MetaMappingCalendar()
-                self.set_meta({"tag": "VCALENDAR"})
                 self.content_suffix = ".ics"
+                self.item_name = "VCALENDAR"
+                self.component_name = "VEVENT"
             elif isinstance(self.collection, api.TaskList):
                 self.meta_mappings = MetaMappingTaskList()
-                self.set_meta({"tag": "VCALENDAR"})
                 self.content_suffix = ".ics"
+                self.item_name = "VCALENDAR"
+                self.component_name = "VTODO"
             elif isinstance(self.collection, api.AddressBook):
                 self.meta_mappings = MetaMappingContacts()
-                self.set_meta({"tag": "VADDRESSBOOK"})
                 self.content_suffix = ".vcf"
+                self.item_name = "VCARD"
+                self.component_name = ""
 
         else:
             self.is_fake = True
@@ -293,9 +294,8 @@ class Collection(BaseCollection):
         if self.is_fake:
             return
 
-        entry = None
-        for entry in self.journal.list():
-            pass
+        # The same single indexed lookup the sync uses to find where to continue from
+        entry = self.etesync._get_last_entry(self.journal._cache_obj)
 
         return entry.uid if entry is not None else self.journal.uid
 
@@ -355,10 +355,13 @@ class Collection(BaseCollection):
 
     def has_uid(self, uid):
         """Check if a UID exists in the collection."""
-        for item in self.get_all():
-            if item.uid == uid:
-                return True
-        return False
+        if self.is_fake:
+            return False
+
+        # The content's uid is extracted from the content itself
+        return self.journal._cache_obj.content_set.where(
+            (api.pim.Content.uid == uid) & ~api.pim.Content.deleted
+        ).exists()
 
     def _get(self, href):
         """Fetch a single item."""
@@ -372,36 +375,15 @@ class Collection(BaseCollection):
             return None
 
         etesync_item = self.collection.get(uid)
-
-        try:
-            item = vobject.readOne(etesync_item.content)
-            # XXX Hack: fake transform 4.0 vCards to 3.0 as 4.0 is not yet widely supported
-            if item.name == "VCARD" and item.contents["version"][0].value == "4.0":
-                # Don't do anything for groups as transforming them won't help anyway.
-                if hasattr(item, "kind") and item.kind.value.lower() == "group":
-                    pass
-                else:
-                    # XXX must be first because we are editing the content and reparsing
-                    if "photo" in item.contents:
-                        content = etesync_item.content
-                        content = VCARD_4_TO_3_PHOTO_URI_REGEX.sub(r"\1;VALUE=uri:", content)
-                        content = VCARD_4_TO_3_PHOTO_INLINE_REGEX.sub(r"\1;ENCODING=b;TYPE=\2:", content)
-                        item = vobject.readOne(content)
-                        if content == etesync_item.content:
-                            # Delete the PHOTO if we haven't managed to convert it
-                            del item.contents["photo"]
-
-                    item.contents["version"][0].value = "3.0"
-            # XXX Hack: add missing FN
-            if item.name == "VCARD" and not hasattr(item, "fn"):
-                item.add("fn").value = str(item.n)
-        except Exception as e:
-            raise RuntimeError("Failed to parse item %r in %r" % (href, self.path)) from e
-        last_modified = ""
-
-        return EteSyncItem(
-            collection=self, vobject_item=item, href=href, last_modified=last_modified, etesync_item=etesync_item
-        )
+        # What we serve is derived from the stored content, so it changes exactly when the stored content does
+        etag = get_etag(etesync_item.content)
+        indexed = {
+            "uid": uid,
+            "name": self.item_name,
+            "component_name": self.component_name,
+        }
+        # Many requests only need the href and etag
+        return self._make_lazy_item(href, etesync_item, uid, etag, "", indexed)
 
     def upload(self, href, vobject_item):
         """Upload a new or replace an existing item."""
@@ -452,11 +434,15 @@ class Collection(BaseCollection):
         if self.is_fake:
             return {}
 
+        virtual_meta = self.meta_mappings.virtual_meta()
         if key is None:
             ret = {}
             for key in self.journal.info.keys():
                 ret[key] = self.meta_mappings.map_get(self.journal.info, key)[1]
+            ret.update(virtual_meta)
             return ret
+        elif key in virtual_meta:
+            return virtual_meta[key]
         else:
             key, value = self.meta_mappings.map_get(self.journal.info, key)
             return value
@@ -470,15 +456,21 @@ class Collection(BaseCollection):
         if self.is_fake:
             return
 
+        virtual_meta = self.meta_mappings.virtual_meta()
         props = {}
         for key, value in _props.items():
+            if key in virtual_meta:
+                # Derived from the collection, so never stored
+                continue
             key, value = self.meta_mappings.map_set(key, value)
             props[key] = value
 
-        # Pop out tag which we don't want
-        # props.pop("tag", None)
+        info = self.journal.info
+        # Journals without any info yet always need writing
+        if info is not None and all(key in info and info[key] == value for key, value in props.items()):
+            # Nothing to change, so don't write
+            return
 
-        self.journal.update_info({})
         self.journal.update_info(props)
         self.journal.save()
 
@@ -492,15 +484,28 @@ class Storage(BaseStorage):
     """Collection stored in several files per calendar."""
 
     _sync_thread_lock = threading.RLock()
-    # Per-object lock for the "global" user and etesync
-    _etesync_user_lock = None
 
     def __init__(self, configuration):
-        self.user = None
-        self.etesync = None
-        self._etesync_user_lock = threading.RLock()
+        # The user and etesync of the request being handled, per thread so different users run in parallel
+        self._request_state = threading.local()
         super().__init__(configuration)
 
+    @property
+    def user(self):
+        return getattr(self._request_state, "user", None)
+
+    @user.setter
+    def user(self, value):
+        self._request_state.user = value
+
+    @property
+    def etesync(self):
+        return getattr(self._request_state, "etesync", None)
+
+    @etesync.setter
+    def etesync(self, value):
+        self._request_state.etesync = value
+
     def discover(self, path, depth="0", child_context_manager=None, user_groups=set([])):
         """Discover a list of collections under the given ``path``.
 
@@ -543,7 +548,7 @@ class Storage(BaseStorage):
                 return
 
             collection = cls(self, path)
-        except api.exceptions.DoesNotExist:
+        except (api.exceptions.DoesNotExist, DoesNotExist):
             return
 
         yield collection
@@ -563,8 +568,7 @@ class Storage(BaseStorage):
                     if journal.collection.TYPE in (api.AddressBook.TYPE, api.Calendar.TYPE, api.TaskList.TYPE):
                         yield cls(self, posixpath.join(path, journal.uid))
         elif len(attributes) == 2:
-            for href in collection._list():
-                yield collection._get(href)
+            yield from collection.get_all()
 
         elif len(attributes) > 2:
             raise RuntimeError("Found more than one attribute. Shouldn't happen")
@@ -625,10 +629,16 @@ class Storage(BaseStorage):
                 else:
                     etesync.sync_thread.request_sync()
 
+        # Reads are served from the local cache while a sync is running (each thread has its own connection, and
+        # WAL gives it a consistent snapshot), unless there's nothing to serve yet. Writes wait for the sync.
         # At most wait for 5 seconds before returning stale data
-        etesync.sync_thread.wait_for_sync(5)
+        if mode == "w" or config.BLOCKING_READS or not etesync.sync_thread.synced_once:
+            etesync.sync_thread.wait_for_sync(5)
+        else:
+            # Still raise errors from the last sync
+            etesync.sync_thread.wait_for_sync(0)
 
-        with self._etesync_user_lock, etesync_for_user(user) as (etesync, _):
+        with user_lock(user), etesync_for_user(user) as (etesync, _):
             self.user = user
             self.etesync = etesync
 
@@ -1,14 +1,15 @@
-import re
+from email.utils import formatdate
 
-import vobject
 from radicale import pathutils
-from radicale.item import Item
+from radicale.item import filter as radicale_filter
 from radicale.storage import (
     BaseCollection,
     ComponentNotFoundError,
 )
 
+from ..local_cache import DoesNotExist, db
 from ..local_cache.models import HrefMapper
+from .item import LazyItemsMixIn
 
 
 class MetaMapping:
@@ -17,6 +18,13 @@ class MetaMapping:
         "D:displayname": ("name", None, None),
     }
 
+    # The type of the collection, served as the "tag" meta without being stored
+    tag = None
+
+    def virtual_meta(self):
+        """The meta that is derived from the collection rather than stored in it."""
+        return {"tag": self.tag}
+
     @classmethod
     def _reverse_mapping(cls, mappings):
         mappings.update({i[1][0]: (i[0], i[1][1], i[1][2]) for i in mappings.items()})
@@ -44,6 +52,7 @@ class MetaMapping:
 
 
 class MetaMappingCalendar(MetaMapping):
+    tag = "VCALENDAR"
     supported_calendar_component = "VEVENT"
     _mappings = MetaMapping._mappings.copy()
     _mappings.update(
@@ -60,6 +69,7 @@ class MetaMappingTaskList(MetaMappingCalendar):
 
 
 class MetaMappingContacts(MetaMapping):
+    tag = "VADDRESSBOOK"
     _mappings = MetaMapping._mappings.copy()
     _mappings.update(
         {
@@ -87,51 +97,7 @@ def _get_attributes_from_path(path):
     return attributes
 
 
-VCARD_4_TO_3_PHOTO_URI_REGEX = re.compile(r"^(PHOTO|LOGO):http", re.MULTILINE)
-VCARD_4_TO_3_PHOTO_INLINE_REGEX = re.compile(r"^(PHOTO|LOGO):data:image/([^;]*);base64,", re.MULTILINE)
-
-
-class EteSyncItem(Item):
-    def __init__(self, *args, **kwargs):
-        """Initialize an item.
-
-        ``collection_path`` the path of the parent collection (optional if
-        ``collection`` is set).
-
-        ``collection`` the parent collection (optional).
-
-        ``href`` the href of the item.
-
-        ``last_modified`` the HTTP-datetime of when the item was modified.
-
-        ``text`` the text representation of the item (optional if
-        ``vobject_item`` is set).
-
-        ``vobject_item`` the vobject item (optional if ``text`` is set).
-
-        ``etag`` the etag of the item (optional). See ``get_etag``.
-
-        ``uid`` the UID of the object (optional). See ``get_uid_from_object``.
-
-        ``name`` the name of the item (optional). See ``vobject_item.name``.
-
-        ``component_name`` the name of the primary component (optional).
-        See ``find_tag``.
-
-        ``time_range`` the enclosing time range.
-        See ``find_tag_and_time_range``.
-
-        """
-        self.etesync_item = kwargs.pop("etesync_item")
-        super().__init__(*args, **kwargs)
-
-    @property
-    def etag(self):
-        """Encoded as quoted-string (see RFC 2616)."""
-        return '"{}"'.format(self.etesync_item.etag)
-
-
-class Collection(BaseCollection):
+class Collection(LazyItemsMixIn, BaseCollection):
     def __init__(self, storage_, path):
         self._storage = storage_
         # Path should already be sanitized
@@ -146,16 +112,16 @@ class Collection(BaseCollection):
             col_type = self.collection.col_type
             if col_type == "etebase.vevent":
                 self.meta_mappings = MetaMappingCalendar()
-                self.set_meta({"tag": "VCALENDAR"})
                 self.content_suffix = ".ics"
+                self.item_name = "VCALENDAR"
             elif col_type == "etebase.vtodo":
                 self.meta_mappings = MetaMappingTaskList()
-                self.set_meta({"tag": "VCALENDAR"})
                 self.content_suffix = ".ics"
+                self.item_name = "VCALENDAR"
             elif col_type == "etebase.vcard":
                 self.meta_mappings = MetaMappingContacts()
-                self.set_meta({"tag": "VADDRESSBOOK"})
                 self.content_suffix = ".vcf"
+                self.item_name = "VCARD"
 
         else:
             self.is_fake = True
@@ -186,31 +152,40 @@ class Collection(BaseCollection):
         delta update. If sync token is missing, all items are returned.
         ValueError is raised for invalid or old tokens.
         """
+        if self.is_fake:
+            return None, ()
+
         token_prefix = "http://radicale.org/ns/sync/"
-        token = None  # XXX "{}{}".format(token_prefix, self.etag.strip('"'))
-        if old_token is not None and old_token.startswith(token_prefix):
-            old_token = old_token[len(token_prefix) :]
+        stoken = self.collection.stoken
+        if stoken is None:
+            # Never synced, so there's nothing to base a token on
+            return None, self._list()
 
-        # FIXME: actually implement filtering by token
-        return token, self._list()
+        token = "{}{}".format(token_prefix, stoken)
+        self.collection.record_sync_token()
+        if not old_token:
+            return token, self._list()
+
+        if not old_token.startswith(token_prefix):
+            raise ValueError("Malformed token: %r" % old_token)
+        old_token = old_token[len(token_prefix) :]
+
+        try:
+            changed = self.collection.changed_since(old_token, self._make_href)
+        except DoesNotExist as e:
+            raise ValueError("Unknown token: %r" % old_token) from e
+
+        return token, changed
+
+    def _make_href(self, uid):
+        return uid + self.content_suffix
 
     def _list(self):
         """List collection items."""
         if self.is_fake:
-            return
+            return ()
 
-        for item in self.collection.list():
-            try:
-                href_mapper = item.cache_item.href.get()
-            except HrefMapper.DoesNotExist:
-                # Generate a new mapper
-                href = item.item.uid + self.content_suffix
-                href_mapper = HrefMapper(content=item.cache_item, href=href)
-                href_mapper.save(force_insert=True)
-
-            href = href_mapper.href
-
-            yield href
+        return self.collection.list_hrefs(self._make_href)
 
     def get_multi(self, hrefs):
         """Fetch multiple items.
@@ -222,60 +197,85 @@ class Collection(BaseCollection):
         exist.
 
         """
-        return ((href, self._get(href)) for href in hrefs)
+        hrefs = set(hrefs)
+        if self.is_fake:
+            for href in hrefs:
+                yield href, None
+            return
+
+        for href, etesync_item in self.collection.get_by_hrefs(hrefs):
+            hrefs.discard(href)
+            yield href, self._make_item(href, etesync_item)
+
+        for href in hrefs:
+            yield href, None
 
     def get_all(self):
         """Fetch all items."""
-        return (self._get(href) for href in self._list())
+        return (item for _, item in self.get_multi(self._list()) if item is not None)
+
+    def get_filtered(self, filters):
+        """Fetch all items with optional filtering.
+
+        Only the items whose indexed component and time range may match are loaded, the rest of the filtering is
+        the same as radicale's.
+
+        """
+        if self.is_fake or not self.tag:
+            return
+
+        tag, start, end, simple = radicale_filter.simplify_prefilters(filters, self.tag)
+        hrefs = self.collection.list_hrefs_in_range(tag, start, end, self._make_href)
+        for _, item in self.get_multi(hrefs):
+            if item is None:
+                continue
+            if tag is not None and tag != item.component_name:
+                continue
+            istart, iend = item.time_range
+            if istart >= end or iend <= start:
+                continue
+            yield item, simple and (start <= istart or iend <= end)
 
     def has_uid(self, uid):
         """Check if a UID exists in the collection."""
-        for item in self.get_all():
-            if item.uid == uid:
-                return True
-        return False
+        if self.is_fake:
+            return False
+
+        # Item names are the UIDs of their content
+        return self.collection.has_uid(uid)
 
     def _get(self, href):
         """Fetch a single item."""
         if self.is_fake:
             return
 
-        try:
-            href_mapper = HrefMapper.get(HrefMapper.href == href)
-            uid = href_mapper.content.uid
-        except HrefMapper.DoesNotExist:
-            return None
-
-        etesync_item = self.collection.get(uid)
-
-        if etesync_item is None:
-            return None
-
-        try:
-            item = vobject.readOne(etesync_item.content)
-            # XXX Hack: fake transform 4.0 vCards to 3.0 as 4.0 is not yet widely supported
-            if item.name == "VCARD" and item.contents["version"][0].value == "4.0":
-                # Don't do anything for groups as transforming them won't help anyway.
-                if hasattr(item, "kind") and item.kind.value.lower() == "group":
-                    pass
-                else:
-                    # XXX must be first because we are editing the content and reparsing
-                    if "photo" in item.contents:
-                        content = etesync_item.content
-                        content = VCARD_4_TO_3_PHOTO_URI_REGEX.sub(r"\1;VALUE=uri:", content)
-                        content = VCARD_4_TO_3_PHOTO_INLINE_REGEX.sub(r"\1;ENCODING=b;TYPE=\2:", content)
-                        item = vobject.readOne(content)
-                        if content == etesync_item.content:
-                            # Delete the PHOTO if we haven't managed to convert it
-                            del item.contents["photo"]
-
-                    item.contents["version"][0].value = "3.0"
-        except Exception as e:
-            raise RuntimeError("Failed to parse item %r in %r" % (href, self.path)) from e
-        last_modified = ""
-
-        return EteSyncItem(
-            collection=self, vobject_item=item, href=href, last_modified=last_modified, etesync_item=etesync_item
+        for _, item in self.get_multi([href]):
+            return item
+
+    def _make_item(self, href, etesync_item):
+        mtime = etesync_item.mtime
+        last_modified = formatdate(mtime / 1000, usegmt=True) if mtime is not None else ""
+        cache_item = etesync_item.cache_item
+
+        if self.item_name == "VCARD":
+            # Not indexed, as these are always the same for vCards
+            component_name = ""
+            time_range = (radicale_filter.TIMESTAMP_MIN, radicale_filter.TIMESTAMP_MAX)
+        elif cache_item.time_start is not None:
+            component_name = cache_item.component_name
+            time_range = (cache_item.time_start, cache_item.time_end)
+        else:
+            component_name = cache_item.component_name
+            time_range = None
+        indexed = {
+            "uid": cache_item.uid,
+            "name": self.item_name,
+            "component_name": component_name,
+            "time_range": time_range,
+        }
+        # Many requests only need what's in the database
+        return self._make_lazy_item(
+            href, etesync_item, cache_item.uid, '"{}"'.format(etesync_item.etag), last_modified, indexed
         )
 
     def upload(self, href, vobject_item):
@@ -291,8 +291,9 @@ class Collection(BaseCollection):
         else:
             etesync_item = self.collection.create(vobject_item)
             etesync_item.save()
-            href_mapper = HrefMapper(content=etesync_item.cache_item, href=href)
-            href_mapper.save(force_insert=True)
+            with db.database_proxy:
+                href_mapper = HrefMapper(content=etesync_item.cache_item, href=href)
+                href_mapper.save(force_insert=True)
 
         return self._get(href)
 
@@ -325,12 +326,16 @@ class Collection(BaseCollection):
         if self.is_fake:
             return {}
 
+        virtual_meta = self.meta_mappings.virtual_meta()
         if key is None:
             ret = {}
             meta = self.collection.meta
             for key in meta.keys():
                 ret[key] = self.meta_mappings.map_get(meta, key)[1]
+            ret.update(virtual_meta)
             return ret
+        elif key in virtual_meta:
+            return virtual_meta[key]
         else:
             meta = self.collection.meta
             key, value = self.meta_mappings.map_get(meta, key)
@@ -345,14 +350,16 @@ class Collection(BaseCollection):
         if self.is_fake:
             return
 
+        virtual_meta = self.meta_mappings.virtual_meta()
         props = {}
         for key, value in _props.items():
+            if key in virtual_meta:
+                # Derived from the collection, so never stored
+                continue
             key, value = self.meta_mappings.map_set(key, value)
             props[key] = value
 
-        # Pop out tag which we don't want
-        # props.pop("tag", None)
-
+        # Only writes if anything changed
         self.collection.update_meta(props)
 
     @property
@@ -0,0 +1,106 @@
+# Copyright © 2017 Tom Hacohen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import contextvars
+import re
+
+from etesync_dav import config
+
+# Whether the client of the current request supports vCard 4.0, set by the application for every request
+native_vcard4 = contextvars.ContextVar("native_vcard4", default=False)
+
+VCARD4_USER_AGENT_REGEX = re.compile(config.VCARD4_USER_AGENTS) if config.VCARD4_USER_AGENTS else None
+VCARD4_ACCEPT_REGEX = re.compile(r"text/vcard\s*;[^,]*version\s*=\s*\"?4\.0", re.IGNORECASE)
+PHOTO_URI_REGEX = re.compile(r"^(PHOTO|LOGO):http")
+PHOTO_INLINE_REGEX = re.compile(r"^(PHOTO|LOGO):data:image/([^;]*);base64,")
+LINE_REGEX = re.compile(r"[^\r\n]*(?:\r\n|\n|\r)|[^\r\n]+$")
+NAME_REGEX = re.compile(r"(?:[^:;.]*\.)?([^:;]*)")
+
+
+def client_supports_vcard4(environ):
+    """Whether the client sending the request with the WSGI ``environ`` supports vCard 4.0."""
+    if VCARD4_ACCEPT_REGEX.search(environ.get("HTTP_ACCEPT", "")):
+        return True
+    user_agent = environ.get("HTTP_USER_AGENT", "")
+    return VCARD4_USER_AGENT_REGEX is not None and VCARD4_USER_AGENT_REGEX.search(user_agent) is not None
+
+
+def _unfold(content):
+    """Split the content into [logical line, original text] pairs, the original text keeps the folding."""
+    lines = []
+    for physical in LINE_REGEX.findall(content):
+        if physical[:1] in (" ", "\t") and lines:
+            lines[-1][0] += physical.rstrip("\r\n")[1:]
+            lines[-1][1] += physical
+        else:
+            lines.append([physical.rstrip("\r\n"), physical])
+    return lines
+
+
+def _name(line):
+    return NAME_REGEX.match(line).group(1).upper()
+
+
+def _value(line):
+    return line.split(":", 1)[1] if ":" in line else ""
+
+
+def _formatted_name(n_value):
+    """The FN for a N value (family;given;additional;prefix;suffix), in English order."""
+    parts = re.split(r"(?<!\\);", n_value)
+    parts += [""] * (5 - len(parts))
+    family, given, additional, prefix, suffix = parts[:5]
+    words = []
+    for part in (prefix, given, additional, family, suffix):
+        words.extend(word for word in re.split(r"(?<!\\),", part) if word)
+    # Already escaped, as we took it as is from N
+    return " ".join(words)
+
+
+def to_vcard3(content, add_missing_fn=False):
+    """Transform a vCard 4.0 to 3.0 on the text level, as 4.0 is not yet widely supported.
+
+    PHOTO and LOGO URIs and inline images are rewritten to their 3.0 form, and if none could be, PHOTOs are dropped.
+    Groups are left alone as transforming them won't help anyway. With ``add_missing_fn``, an FN is also added (for
+    any version) if missing. Returns ``content`` itself if there is nothing to change.
+    """
+    if content.lstrip()[:11].upper() != "BEGIN:VCARD":
+        return content
+
+    lines = _unfold(content)
+    names = [_name(line) for line, _ in lines]
+    values = {name: _value(line) for name, (line, _) in zip(names, lines)}
+
+    convert = values.get("VERSION") == "4.0" and values.get("KIND", "").lower() != "group"
+    add_fn = add_missing_fn and "FN" not in values
+    if not convert and not add_fn:
+        return content
+
+    rewritten = False
+    out = []
+    for name, (line, text) in zip(names, lines):
+        if convert and name == "VERSION":
+            text = "VERSION:3.0" + text[len(text.rstrip("\r\n")) :]
+        elif convert and name in ("PHOTO", "LOGO"):
+            new_text = PHOTO_URI_REGEX.sub(r"\1;VALUE=uri:", text)
+            new_text = PHOTO_INLINE_REGEX.sub(r"\1;ENCODING=b;TYPE=\2:", new_text)
+            rewritten |= new_text != text
+            text = new_text
+        elif add_fn and name == "END":
+            out.append(("FN", "FN:{}\r\n".format(_formatted_name(values.get("N", "")))))
+        out.append((name, text))
+
+    # Delete the PHOTO if we haven't managed to convert it
+    drop_photo = convert and not rewritten
+    return "".join(text for name, text in out if not (drop_photo and name == "PHOTO"))
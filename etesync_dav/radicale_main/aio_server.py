@@ -0,0 +1,276 @@
+# Copyright © 2017 Tom Hacohen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Asyncio based WSGI server.
+
+Connections are read from and written to asynchronously, so idle (kept alive) ones cost no thread, and only the
+application calls run in a fixed number of worker threads.
+
+"""
+
+import asyncio
+import io
+import socket
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from http import HTTPStatus
+from urllib.parse import unquote
+
+from radicale.log import logger
+
+from .server import DEFAULT_POOL_SIZE, MyApplication, create_ssl_context, format_address
+
+# Maximum size of the request line and of each header line
+MAX_LINE_SIZE = 65536
+MAX_HEADERS = 100
+# The same as wsgiref's
+ERROR_BODY = b"A server error occurred.  Please contact the administrator."
+
+
+class BadRequest(Exception):
+    def __init__(self, status):
+        super().__init__(status.phrase)
+        self.status = status
+
+
+async def _read_line(reader, too_long_status):
+    try:
+        return await reader.readline()
+    except ValueError:
+        # Longer than the limit
+        raise BadRequest(too_long_status)
+
+
+class AsyncServer:
+    def __init__(self, configuration):
+        self.configuration = configuration
+        self.application = MyApplication(configuration)
+        self.timeout = configuration.get("server", "timeout") or None
+        self.max_content_length = configuration.get("server", "max_content_length")
+        self.ssl_context = create_ssl_context(configuration) if configuration.get("server", "ssl") else None
+        max_connections = configuration.get("server", "max_connections")
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_connections if max_connections > 0 else DEFAULT_POOL_SIZE,
+            thread_name_prefix="radicale-worker",
+        )
+        self._connections = set()
+        # Connections waiting for their next request, closed right away when stopping
+        self._idle = set()
+        self._stopping = False
+
+    async def serve(self, shutdown_socket):
+        servers = []
+        for address in self.configuration.get("server", "hosts"):
+            # Try to bind sockets for IPv4 and IPv6, only one must work
+            errors = []
+            for family in (socket.AF_INET, socket.AF_INET6):
+                try:
+                    server = await asyncio.start_server(
+                        self._handle_connection,
+                        address[0],
+                        address[1],
+                        family=family,
+                        ssl=self.ssl_context,
+                        limit=MAX_LINE_SIZE + 2,
+                    )
+                except OSError as e:
+                    errors.append(e)
+                    continue
+                servers.append(server)
+                for sock in server.sockets:
+                    logger.info(
+                        "Listening on %r%s",
+                        format_address(sock.getsockname()),
+                        " with SSL" if self.ssl_context else "",
+                    )
+            if len(errors) == 2:
+                e = errors[0]
+                raise RuntimeError("Failed to start server %r: %s" % (format_address(address), e)) from e
+        assert servers, "no servers started"
+
+        logger.info("Radicale server ready")
+        # Closed by the signal handlers to notify of program shutdown
+        shutdown_socket.setblocking(False)
+        await asyncio.get_running_loop().sock_recv(shutdown_socket, 1)
+        logger.info("Stopping Radicale")
+
+        self._stopping = True
+        for server in servers:
+            server.close()
+        for writer in list(self._idle):
+            writer.close()
+        # Let the requests being handled finish
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        self._executor.shutdown()
+
+    async def _handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while await self._handle_request(reader, writer) and not self._stopping:
+                pass
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            logger.debug("Connection closed by the client or timed out")
+        except Exception as e:
+            logger.error("An exception occurred during request: %s", e, exc_info=True)
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def _handle_request(self, reader, writer):
+        """Read a request and write its response, returns whether the connection can be used for another one."""
+        try:
+            self._idle.add(writer)
+            try:
+                request_line = await asyncio.wait_for(_read_line(reader, HTTPStatus.REQUEST_URI_TOO_LONG), self.timeout)
+            finally:
+                self._idle.discard(writer)
+            if not request_line:
+                return False
+
+            environ, keep_alive = await asyncio.wait_for(self._read_request(reader, writer, request_line), self.timeout)
+        except BadRequest as e:
+            self._write_response(writer, "%d %s" % (e.status, e.status.phrase), [("Content-Length", "0")], b"", False)
+            await writer.drain()
+            return False
+
+        loop = asyncio.get_running_loop()
+        try:
+            status, headers, body = await loop.run_in_executor(self._executor, self._call_application, environ)
+        except Exception as e:
+            logger.error("An exception occurred during request: %s", e, exc_info=True)
+            status = HTTPStatus.INTERNAL_SERVER_ERROR
+            headers = [("Content-Type", "text/plain"), ("Content-Length", str(len(ERROR_BODY)))]
+            body = ERROR_BODY if environ["REQUEST_METHOD"] != "HEAD" else b""
+            # The application may have failed in the middle of anything, so don't reuse the connection
+            self._write_response(writer, "%d %s" % (status, status.phrase), headers, body, False)
+            await writer.drain()
+            return False
+
+        if environ["REQUEST_METHOD"] == "HEAD":
+            body = b""
+        elif not any(name.lower() == "content-length" for name, _ in headers):
+            headers.append(("Content-Length", str(len(body))))
+        keep_alive = keep_alive and not self._stopping
+        self._write_response(writer, status, headers, body, keep_alive)
+        await writer.drain()
+        return keep_alive
+
+    async def _read_request(self, reader, writer, request_line):
+        """Read the rest of the request, returns its WSGI environ and whether the client wants to keep the connection
+        alive."""
+        try:
+            method, target, version = request_line.decode("latin-1").split()
+        except ValueError:
+            raise BadRequest(HTTPStatus.BAD_REQUEST)
+        if version not in ("HTTP/1.0", "HTTP/1.1"):
+            raise BadRequest(HTTPStatus.HTTP_VERSION_NOT_SUPPORTED)
+
+        path, _, query = target.partition("?")
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote(path),
+            "QUERY_STRING": query,
+            "SERVER_PROTOCOL": version,
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "https" if self.ssl_context else "http",
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        sockname = writer.get_extra_info("sockname")
+        environ["SERVER_NAME"], environ["SERVER_PORT"] = sockname[0], str(sockname[1])
+        peername = writer.get_extra_info("peername")
+        environ["REMOTE_ADDR"] = peername[0] if peername else ""
+        if self.ssl_context:
+            # The certificate can be evaluated by the auth module
+            environ["REMOTE_CERTIFICATE"] = writer.get_extra_info("peercert")
+
+        for _ in range(MAX_HEADERS + 1):
+            line = await _read_line(reader, HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+            if not line.endswith(b"\n"):
+                # The connection was closed in the middle of the request
+                raise asyncio.IncompleteReadError(line, None)
+            line = line.decode("latin-1").rstrip("\r\n")
+            if not line:
+                break
+            name, sep, value = line.partition(":")
+            if not sep:
+                raise BadRequest(HTTPStatus.BAD_REQUEST)
+            key = name.strip().upper().replace("-", "_")
+            if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                key = "HTTP_" + key
+            value = value.strip()
+            environ[key] = "%s,%s" % (environ[key], value) if key in environ else value
+        else:
+            raise BadRequest(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+
+        connection = environ.get("HTTP_CONNECTION", "").lower()
+        keep_alive = version == "HTTP/1.1" and "close" not in connection
+
+        if "HTTP_TRANSFER_ENCODING" in environ:
+            raise BadRequest(HTTPStatus.LENGTH_REQUIRED)
+        try:
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            raise BadRequest(HTTPStatus.BAD_REQUEST)
+        if length < 0:
+            raise BadRequest(HTTPStatus.BAD_REQUEST)
+        if self.max_content_length and length > self.max_content_length:
+            raise BadRequest(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+
+        if length and environ.get("HTTP_EXPECT", "").lower() == "100-continue" and version == "HTTP/1.1":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        environ["wsgi.input"] = io.BytesIO(await reader.readexactly(length) if length else b"")
+
+        return environ, keep_alive
+
+    def _call_application(self, environ):
+        response = []
+        body = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and response:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response[:] = [status, list(headers)]
+            return body.append
+
+        answers = self.application(environ, start_response)
+        try:
+            body.extend(answers)
+        finally:
+            if hasattr(answers, "close"):
+                answers.close()
+
+        status, headers = response
+        return status, headers, b"".join(body)
+
+    def _write_response(self, writer, status, headers, body, keep_alive):
+        lines = ["HTTP/1.1 %s" % status]
+        lines.extend("%s: %s" % header for header in headers)
+        if not any(name.lower() == "date" for name, _ in headers):
+            lines.append("Date: %s" % formatdate(usegmt=True))
+        if not keep_alive:
+            lines.append("Connection: close")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+
+
+def serve(configuration, shutdown_socket):
+    """Serve radicale from configuration, handling connections asynchronously."""
+    server = AsyncServer(configuration)
+    asyncio.run(server.serve(shutdown_socket))
@@ -24,17 +24,24 @@ Built-in WSGI server.
 
 import errno
 import os
+import queue
 import select
 import socket
 import socketserver
 import ssl
 import sys
+import threading
+import time
 import wsgiref.simple_server
 from urllib.parse import unquote
 
 from radicale import Application, config
 from radicale.log import logger
 
+from etesync_dav.config import SERVER_MODE
+
+from ..radicale import vcard
+
 if hasattr(socket, "EAI_ADDRFAMILY"):
     COMPAT_EAI_ADDRFAMILY = socket.EAI_ADDRFAMILY
 elif hasattr(socket, "EAI_NONAME"):
@@ -51,8 +58,27 @@ elif os.name == "nt":
     # Workaround: https://bugs.python.org/issue29515
     COMPAT_IPPROTO_IPV6 = 41
 
+# Workers used by the pooled server if max_connections is unlimited
+DEFAULT_POOL_SIZE = 8
+# Maximum time, in seconds, a kept alive connection may wait for its next request
+KEEP_ALIVE_TIMEOUT = 5
+# How often, in seconds, a kept alive connection checks whether to make room for connections waiting for a worker
+IDLE_CHECK_INTERVAL = 0.1
+# Maximum size of unread request bodies read to keep the connection alive, bigger ones close it instead
+MAX_DRAIN_SIZE = 1024 * 1024
+# How often, in seconds, the main loop checks whether a saturated server can accept connections again
+ACCEPT_RETRY_INTERVAL = 0.1
+
 
 class MyApplication(Application):
+    def __call__(self, environ, start_response):
+        # Worker threads are reused, so reset the per request state when done
+        token = vcard.native_vcard4.set(vcard.client_supports_vcard4(environ))
+        try:
+            return super().__call__(environ, start_response)
+        finally:
+            vcard.native_vcard4.reset(token)
+
     def do_POST(self, environ, base_prefix, path, user, remote_host="", user_agent=""):
         """Manage POST request."""
         # Dispatch .web URL to web module
@@ -69,6 +95,8 @@ def format_address(address):
 class ParallelHTTPServer(socketserver.ThreadingMixIn, wsgiref.simple_server.WSGIServer):
     # We wait for child threads ourself
     block_on_close = False
+    # Close connections after every request
+    keep_alive = False
 
     def __init__(self, configuration, family, address, RequestHandlerClass):
         self.configuration = configuration
@@ -82,12 +110,21 @@ class ParallelHTTPServer(socketserver.ThreadingMixIn, wsgiref.simple_server.WSGI
             self.socket.setsockopt(COMPAT_IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
         super().server_bind()
 
-    def get_request(self):
+    @property
+    def accepting(self):
+        """Whether the server can take new connections, limiting them is left to the main loop."""
+        return True
+
+    def _accept(self):
         # Set timeout for client
         request, client_address = super().get_request()
         timeout = self.configuration.get("server", "timeout")
         if timeout:
             request.settimeout(timeout)
+        return request, client_address
+
+    def get_request(self):
+        request, client_address = self._accept()
         client_socket, client_socket_out = socket.socketpair()
         self.client_sockets.add(client_socket_out)
         return request, (*client_address, client_socket)
@@ -110,31 +147,36 @@ class ParallelHTTPServer(socketserver.ThreadingMixIn, wsgiref.simple_server.WSGI
             logger.error("An exception occurred during request: %s", sys.exc_info()[1], exc_info=True)
 
 
+def create_ssl_context(configuration):
+    certfile = configuration.get("server", "certificate")
+    keyfile = configuration.get("server", "key")
+    cafile = configuration.get("server", "certificate_authority")
+    # Test if the files can be read
+    for name, filename in [("certificate", certfile), ("key", keyfile), ("certificate_authority", cafile)]:
+        type_name = config.DEFAULT_CONFIG_SCHEMA["server"][name]["type"].__name__
+        source = configuration.get_source("server", name)
+        if name == "certificate_authority" and not filename:
+            continue
+        try:
+            open(filename, "r").close()
+        except OSError as e:
+            raise RuntimeError(
+                "Invalid %s value for option %r in section %r in %s: %r "
+                "(%s)" % (type_name, name, "server", source, filename, e)
+            ) from e
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+    if cafile:
+        context.load_verify_locations(cafile=cafile)
+        context.verify_mode = ssl.CERT_REQUIRED
+    return context
+
+
 class ParallelHTTPSServer(ParallelHTTPServer):
     def server_bind(self):
         super().server_bind()
         # Wrap the TCP socket in an SSL socket
-        certfile = self.configuration.get("server", "certificate")
-        keyfile = self.configuration.get("server", "key")
-        cafile = self.configuration.get("server", "certificate_authority")
-        # Test if the files can be read
-        for name, filename in [("certificate", certfile), ("key", keyfile), ("certificate_authority", cafile)]:
-            type_name = config.DEFAULT_CONFIG_SCHEMA["server"][name]["type"].__name__
-            source = self.configuration.get_source("server", name)
-            if name == "certificate_authority" and not filename:
-                continue
-            try:
-                open(filename, "r").close()
-            except OSError as e:
-                raise RuntimeError(
-                    "Invalid %s value for option %r in section %r in %s: %r "
-                    "(%s)" % (type_name, name, "server", source, filename, e)
-                ) from e
-        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-        context.load_cert_chain(certfile=certfile, keyfile=keyfile)
-        if cafile:
-            context.load_verify_locations(cafile=cafile)
-            context.verify_mode = ssl.CERT_REQUIRED
+        context = create_ssl_context(self.configuration)
         self.socket = context.wrap_socket(self.socket, server_side=True, do_handshake_on_connect=False)
 
     def finish_request_locked(self, request, client_address):
@@ -154,13 +196,129 @@ class ParallelHTTPSServer(ParallelHTTPServer):
         return super().finish_request_locked(request, client_address)
 
 
+class PooledServerMixIn:
+    """Handle connections in a fixed number of worker threads, keeping them alive between requests.
+
+    Accepted connections wait for a worker in a bounded queue, and no more are accepted while it's full.
+    """
+
+    keep_alive = True
+
+    def __init__(self, configuration, *args, **kwargs):
+        max_connections = configuration.get("server", "max_connections")
+        pool_size = max_connections if max_connections > 0 else DEFAULT_POOL_SIZE
+        self._requests = queue.Queue(maxsize=pool_size)
+        # Only started once bound, the server is closed right away if that fails
+        self._workers = []
+        super().__init__(configuration, *args, **kwargs)
+        for i in range(pool_size):
+            worker = threading.Thread(target=self._process_requests, name="radicale-worker-%d" % i, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    @property
+    def accepting(self):
+        return not self._requests.full()
+
+    @property
+    def connections_waiting(self):
+        """Whether accepted connections are waiting for a worker."""
+        return not self._requests.empty()
+
+    def get_request(self):
+        # No need to notify the main loop of finished connections
+        return self._accept()
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def _process_requests(self):
+        while True:
+            job = self._requests.get()
+            if job is None:
+                return
+            request, client_address = job
+            try:
+                self.finish_request_locked(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        for _ in self._workers:
+            self._requests.put(None)
+        for worker in self._workers:
+            worker.join()
+
+
+class PooledHTTPServer(PooledServerMixIn, ParallelHTTPServer):
+    pass
+
+
+class PooledHTTPSServer(PooledServerMixIn, ParallelHTTPSServer):
+    pass
+
+
+class RequestBody:
+    """The body of a request, so reading it never goes on to the next request of the connection."""
+
+    def __init__(self, rfile, length):
+        self._rfile = rfile
+        self.remaining = length
+
+    def _limit(self, size):
+        if size is None or size < 0 or size > self.remaining:
+            return self.remaining
+        return size
+
+    def read(self, size=-1):
+        data = self._rfile.read(self._limit(size))
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self._rfile.readline(self._limit(size))
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, b""))
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+    def drain(self):
+        """Read the rest of the body, returns whether all of it could be read."""
+        while self.remaining > 0:
+            if not self.read(64 * 1024):
+                return False
+        return True
+
+
 class ServerHandler(wsgiref.simple_server.ServerHandler):
     # Don't pollute WSGI environ with OS environment
     os_environ = {}
+    # Whether the connection stays open after the response, set by the request handler
+    keep_alive = False
 
     def log_exception(self, exc_info):
         logger.error("An exception occurred during request: %s", exc_info[1], exc_info=exc_info)
 
+    def handle_error(self):
+        # The response may be incomplete
+        self.keep_alive = False
+        super().handle_error()
+
+    def cleanup_headers(self):
+        super().cleanup_headers()
+        if "Content-Length" not in self.headers:
+            # The client can only tell where the response ends by the connection closing
+            self.keep_alive = False
+        if self.http_version == "1.1" and not self.keep_alive:
+            self.headers["Connection"] = "close"
+
 
 class RequestHandler(wsgiref.simple_server.WSGIRequestHandler):
     """HTTP requests handler."""
@@ -180,10 +338,63 @@ class RequestHandler(wsgiref.simple_server.WSGIRequestHandler):
         env["PATH_INFO"] = unquote(self.path.split("?", 1)[0])
         return env
 
+    def setup(self):
+        # Responses are written in parts, which otherwise get delayed on kept alive connections
+        self.disable_nagle_algorithm = self.server.keep_alive
+        super().setup()
+
     def handle(self):
-        """Copy of WSGIRequestHandler.handle with different ServerHandler"""
+        if self.server.keep_alive:
+            # Makes parse_request keep the connection open unless the client asks otherwise
+            self.protocol_version = "HTTP/1.1"
+        self.close_connection = True
+        self.kept_alive = False
+        self.handle_one_request()
+        while not self.close_connection:
+            self.kept_alive = True
+            self.handle_one_request()
+
+    def _has_buffered_data(self):
+        """Whether data was already received, which select() doesn't notice."""
+        if hasattr(self.connection, "pending") and self.connection.pending():
+            return True
+        timeout = self.connection.gettimeout()
+        self.connection.settimeout(0)
+        try:
+            return bool(self.rfile.peek(1))
+        except (ssl.SSLWantReadError, BlockingIOError):
+            return False
+        finally:
+            self.connection.settimeout(timeout)
+
+    def _wait_for_request(self):
+        """Wait for the next request of a kept alive connection, returns whether there is one.
 
-        self.raw_requestline = self.rfile.readline(65537)
+        Gives up early if other connections are waiting for a worker.
+        """
+        timeout = self.server.configuration.get("server", "timeout")
+        deadline = time.monotonic() + (min(timeout, KEEP_ALIVE_TIMEOUT) if timeout else KEEP_ALIVE_TIMEOUT)
+        try:
+            while not self._has_buffered_data():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self.server.connections_waiting:
+                    return False
+                rlist, _, _ = select.select([self.connection], [], [], min(remaining, IDLE_CHECK_INTERVAL))
+                if rlist:
+                    break
+            self.raw_requestline = self.rfile.readline(65537)
+        except (socket.timeout, ConnectionError):
+            return False
+        return bool(self.raw_requestline)
+
+    def handle_one_request(self):
+        """Copy of WSGIRequestHandler.handle with different ServerHandler, and support for keep-alive"""
+
+        if not self.kept_alive:
+            self.raw_requestline = self.rfile.readline(65537)
+        elif not self._wait_for_request():
+            self.close_connection = True
+            return
         if len(self.raw_requestline) > 65536:
             self.requestline = ""
             self.request_version = ""
@@ -194,10 +405,31 @@ class RequestHandler(wsgiref.simple_server.WSGIRequestHandler):
         if not self.parse_request():
             return
 
-        handler = ServerHandler(self.rfile, self.wfile, self.get_stderr(), self.get_environ())
+        # parse_request only keeps the connection open for HTTP/1.1 clients (unless they asked to close it)
+        keep_alive = not self.close_connection
+        self.close_connection = True
+        stdin = self.rfile
+        if keep_alive:
+            try:
+                if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+                    raise ValueError("Chunked request bodies are not supported")
+                stdin = RequestBody(self.rfile, int(self.headers.get("Content-Length") or 0))
+            except ValueError:
+                # Where the body ends is unknown, so the connection can't be used for another request
+                keep_alive = False
+            # Make room for connections waiting for a worker
+            keep_alive = keep_alive and not self.server.connections_waiting
+
+        handler = ServerHandler(stdin, self.wfile, self.get_stderr(), self.get_environ())
         handler.request_handler = self
+        if self.server.keep_alive:
+            handler.http_version = "1.1"
+        handler.keep_alive = keep_alive
         handler.run(self.server.get_app())
 
+        if handler.keep_alive and stdin.remaining <= MAX_DRAIN_SIZE and stdin.drain():
+            self.close_connection = False
+
 
 def serve(configuration, shutdown_socket):
     """Serve radicale from configuration."""
@@ -206,8 +438,20 @@ def serve(configuration, shutdown_socket):
     configuration = configuration.copy()
     configuration.update({"server": {"_internal_server": "True"}}, "server", privileged=True)
 
+    if SERVER_MODE == "asyncio":
+        # Imported here as it builds on this module
+        from . import aio_server
+
+        aio_server.serve(configuration, shutdown_socket)
+        return
+
     use_ssl = configuration.get("server", "ssl")
-    server_class = ParallelHTTPSServer if use_ssl else ParallelHTTPServer
+    if SERVER_MODE == "pooled":
+        server_class = PooledHTTPSServer if use_ssl else PooledHTTPServer
+    elif SERVER_MODE == "threaded":
+        server_class = ParallelHTTPSServer if use_ssl else ParallelHTTPServer
+    else:
+        raise RuntimeError("Invalid server mode: %r" % SERVER_MODE)
     application = MyApplication(configuration)
     servers = {}
     try:
@@ -266,11 +510,16 @@ def serve(configuration, shutdown_socket):
             for server in servers.values():
                 rlist.extend(server.client_sockets)
             # Accept new connections if max_connections is not reached
+            timeout = select_timeout
             if max_connections <= 0 or len(rlist) < max_connections:
-                rlist.extend(servers)
+                accepting = [s for s, server in servers.items() if server.accepting]
+                if len(accepting) < len(servers):
+                    # Saturated servers don't notify when they can accept again
+                    timeout = ACCEPT_RETRY_INTERVAL
+                rlist.extend(accepting)
             # Use socket to get notified of program shutdown
             rlist.append(shutdown_socket)
-            rlist, _, xlist = select.select(rlist, [], xlist, select_timeout)
+            rlist, _, xlist = select.select(rlist, [], xlist, timeout)
             if xlist:
                 raise RuntimeError("unhandled socket error")
             rlist = set(rlist)
@@ -0,0 +1,256 @@
+# Copyright © 2017 Tom Hacohen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import etebase
+except ImportError:
+    etebase = None
+
+
+class FakeCol:
+    def __init__(self, meta, collection_type="etebase.vevent"):
+        self.meta = meta
+        self.collection_type = collection_type
+
+
+class FakeItem:
+    def __init__(self, uid, content=b""):
+        # Etebase items have uids of their own, unrelated to the uid of their content
+        self.uid = "eb-" + uid
+        self.meta = {"name": uid, "mtime": None}
+        self.content = content
+        self.deleted = False
+        self.etag = "etag-" + uid
+
+
+class FakeItemList:
+    def __init__(self, data, stoken):
+        self.data = data
+        self.stoken = stoken
+        self.done = True
+
+
+class FakeItemMgr:
+    """Returns all of the items in a single page, whatever the stoken. Only the name of the items is serialized."""
+
+    def __init__(self, items=(), stoken=None):
+        self.items = items
+        self.stoken = stoken
+
+    def list(self, fetch_options):
+        return FakeItemList(self.items, self.stoken)
+
+    def cache_save(self, item):
+        from etesync_dav.local_cache import msgpack_encode
+
+        return msgpack_encode(item.meta["name"])
+
+    def cache_load(self, cached):
+        from etesync_dav.local_cache import msgpack_decode
+
+        return FakeItem(msgpack_decode(cached))
+
+
+class FakeColMgr:
+    """Serializes collections like etebase's collection manager, without the encryption."""
+
+    def __init__(self, item_mgr=None):
+        self.item_mgr = item_mgr if item_mgr is not None else FakeItemMgr()
+
+    def cache_save(self, col):
+        from etesync_dav.local_cache import msgpack_encode
+
+        return msgpack_encode([col.meta, col.collection_type])
+
+    def cache_load(self, cached):
+        from etesync_dav.local_cache import msgpack_decode
+
+        return FakeCol(*msgpack_decode(cached))
+
+    def get_item_manager(self, col):
+        return self.item_mgr
+
+
+class FakeAccount:
+    def __init__(self, col_mgr):
+        self.col_mgr = col_mgr
+
+    def get_collection_manager(self):
+        return self.col_mgr
+
+
+def event(uid, start, end):
+    return (
+        (
+            "BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:test\r\nBEGIN:VEVENT\r\nUID:{uid}\r\nDTSTAMP:{start}\r\n"
+            "DTSTART:{start}\r\nDTEND:{end}\r\nSUMMARY:Test\r\nEND:VEVENT\r\nEND:VCALENDAR\r\n"
+        )
+        .format(uid=uid, start=start, end=end)
+        .encode()
+    )
+
+
+def item_row(uid):
+    return dict(
+        uid=uid,
+        eb_item=FakeItemMgr().cache_save(FakeItem(uid)),
+        deleted=False,
+        etag="etag-" + uid,
+        mtime=None,
+        content=None,
+        component_name=None,
+        time_start=None,
+        time_end=None,
+    )
+
+
+@unittest.skipIf(etebase is None, "etebase is not installed")
+class LocalCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        from etesync_dav.local_cache import Etebase, db, models
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.database = db.TrackingDatabase(
+            os.path.join(self.tmp_dir, "etebase_data.db"), pragmas={"journal_mode": "wal", "foreign_keys": 1}
+        )
+        db.database_proxy.initialize(self.database)
+        # Only the database parts are used, which don't need an account
+        self.etesync = Etebase.__new__(Etebase)
+        with db.database_proxy:
+            self.etesync._init_db_tables(self.database)
+            self.user = models.User.create(username="test")
+
+    def tearDown(self):
+        self.database.close_all()
+        shutil.rmtree(self.tmp_dir)
+
+    def create_collection(self, uid, meta):
+        from etesync_dav.local_cache import models
+
+        return models.CollectionEntity.create(
+            local_user=self.user, uid=uid, eb_col=FakeColMgr().cache_save(FakeCol(meta))
+        )
+
+    def get_collection(self, uid):
+        from etesync_dav.local_cache import models
+
+        return models.CollectionEntity.get(local_user=self.user, uid=uid)
+
+
+class ChangeSeqTest(LocalCacheTestCase):
+    def test_stale_update_meta(self):
+        from etesync_dav.local_cache import Collection
+
+        self.create_collection("col", {"name": "Calendar"})
+        self.etesync._save_pulled_items(self.get_collection("col"), [item_row("a")], "s1")
+        # Loaded by a request before the next pull
+        stale = self.get_collection("col")
+        self.etesync._save_pulled_items(self.get_collection("col"), [item_row("b")], "s2")
+
+        Collection(FakeColMgr(), stale).update_meta({"name": "Renamed"})
+        cache_col = self.get_collection("col")
+        self.assertEqual(cache_col.local_stoken, "s2")
+        self.assertEqual(cache_col.change_seq, 2)
+        self.assertEqual(FakeColMgr().cache_load(cache_col.eb_col).meta["name"], "Renamed")
+
+        # Changes after the update must be seen by clients that synced at s2
+        self.etesync._save_pulled_items(self.get_collection("col"), [item_row("c")], "s3")
+        collection = Collection(FakeColMgr(), self.get_collection("col"))
+        self.assertEqual(collection.changed_since("s2", lambda uid: uid + ".ics"), ["eb-c.ics"])
+
+    def test_next_change_seq_after_overwritten_row(self):
+        from etesync_dav.local_cache import _next_change_seq, db, models
+
+        cache_col = self.create_collection("col", {"name": "Calendar"})
+        self.etesync._save_pulled_items(cache_col, [item_row("a")], "s1")
+        self.etesync._save_pulled_items(cache_col, [item_row("b")], "s2")
+
+        with db.database_proxy:
+            # As if an older version of the row was written back
+            models.CollectionEntity.update(change_seq=1).where(models.CollectionEntity.id == cache_col.id).execute()
+            self.assertEqual(_next_change_seq(cache_col.id), 3)
+
+    def test_next_change_seq_after_empty_page(self):
+        from etesync_dav.local_cache import Collection
+
+        cache_col = self.create_collection("col", {"name": "Calendar"})
+        self.etesync._save_pulled_items(cache_col, [item_row("a")], "s1")
+        self.etesync._save_pulled_items(cache_col, [], "s2")
+        self.etesync._save_pulled_items(cache_col, [item_row("b")], "s3")
+
+        collection = Collection(FakeColMgr(), self.get_collection("col"))
+        self.assertEqual(collection.changed_since("s2", lambda uid: uid + ".ics"), ["eb-b.ics"])
+
+
+class MigrationTest(LocalCacheTestCase):
+    def downgrade(self, db_version, columns):
+        """Make the database look like one of ``db_version``, from before ``columns`` were added."""
+        from etesync_dav.local_cache import db, models
+
+        with db.database_proxy:
+            indexes = self.database.execute_sql(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql LIKE '%time_end%'",
+                (models.ItemEntity._meta.table_name,),
+            ).fetchall()
+            for (index,) in indexes:
+                self.database.execute_sql('DROP INDEX "{}"'.format(index))
+            for column in columns:
+                self.database.execute_sql(
+                    'ALTER TABLE "{}" DROP COLUMN "{}"'.format(models.ItemEntity._meta.table_name, column)
+                )
+            models.Config.update(db_version=db_version).execute()
+
+    def check_upgrade(self, db_version, columns):
+        from etesync_dav.local_cache import Collection, db, models
+
+        old_event = FakeItem("old", event("old", "20100101T100000Z", "20100101T110000Z"))
+        new_event = FakeItem("new", event("new", "20200101T100000Z", "20200101T110000Z"))
+        cache_col = self.create_collection("col", {"name": "Calendar"})
+        models.CollectionEntity.update(stoken="s1").where(models.CollectionEntity.id == cache_col.id).execute()
+        self.etesync._save_pulled_items(cache_col, [item_row("old")], "s1")
+        self.downgrade(db_version, columns)
+
+        with db.database_proxy:
+            self.etesync._init_db_tables(self.database)
+            self.assertEqual(models.Config.get().db_version, 4)
+        # The items cached before the upgrade have to be pulled again for filling the new columns
+        self.assertIsNone(self.get_collection("col").local_stoken)
+
+        item_mgr = FakeItemMgr([old_event, new_event], "s1")
+        self.etesync.etebase = FakeAccount(FakeColMgr(item_mgr))
+        self.etesync.user = self.user
+        self.etesync.plaintext_cipher = None
+        self.assertEqual(self.etesync._collections_to_sync(), (["col"], 0))
+        self.etesync.pull_collection("col")
+
+        collection = Collection(FakeColMgr(item_mgr), self.get_collection("col"))
+        self.assertEqual(collection.stoken, "s1")
+        # 2020-01-01 to 2021-01-01
+        hrefs = collection.list_hrefs_in_range("VEVENT", 1577836800, 1609459200, lambda uid: uid + ".ics")
+        self.assertEqual(hrefs, ["eb-new.ics"])
+
+    def test_upgrade_from_version_2(self):
+        self.check_upgrade(2, ["etag", "mtime", "content", "component_name", "time_start", "time_end"])
+
+    def test_upgrade_from_version_3(self):
+        self.check_upgrade(3, ["component_name", "time_start", "time_end"])
+
+
+if __name__ == "__main__":
+    unittest.main()
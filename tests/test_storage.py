@@ -0,0 +1,62 @@
+# Copyright © 2017 Tom Hacohen
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+from unittest import mock
+
+try:
+    import etebase
+except ImportError:
+    etebase = None
+
+
+@unittest.skipIf(etebase is None, "etebase is not installed")
+class NextIntervalTest(unittest.TestCase):
+    def setUp(self):
+        from etesync_dav.radicale.storage import SyncThread
+
+        self.sync_thread = SyncThread("test")
+
+    def test_active(self):
+        from etesync_dav.radicale.storage import SYNC_INTERVAL_ACTIVE
+
+        self.assertEqual(self.sync_thread._next_interval(True), SYNC_INTERVAL_ACTIVE)
+        self.sync_thread.interval = 8 * 60
+        self.assertEqual(self.sync_thread._next_interval(True), SYNC_INTERVAL_ACTIVE)
+
+    def test_idle(self):
+        from etesync_dav.radicale.storage import SYNC_INTERVAL, SYNC_INTERVAL_ACTIVE
+
+        with mock.patch("etesync_dav.config.SYNC_INTERVAL_IDLE", 4 * SYNC_INTERVAL):
+            self.sync_thread.interval = SYNC_INTERVAL_ACTIVE
+            self.assertEqual(self.sync_thread._next_interval(False), 2 * SYNC_INTERVAL_ACTIVE)
+
+            # Backs off beyond the regular interval, up to the idle one
+            intervals = []
+            self.sync_thread.interval = SYNC_INTERVAL
+            for _ in range(4):
+                self.sync_thread.interval = self.sync_thread._next_interval(False)
+                intervals.append(self.sync_thread.interval)
+            self.assertEqual(intervals, [2 * SYNC_INTERVAL, 4 * SYNC_INTERVAL, 4 * SYNC_INTERVAL, 4 * SYNC_INTERVAL])
+
+    def test_legacy(self):
+        from etesync_dav.radicale.storage import SYNC_INTERVAL, SYNC_INTERVAL_ACTIVE
+
+        self.assertEqual(self.sync_thread._next_interval(None), SYNC_INTERVAL)
+        self.sync_thread.interval = SYNC_INTERVAL_ACTIVE
+        self.assertEqual(self.sync_thread._next_interval(None), SYNC_INTERVAL)
+
+
+if __name__ == "__main__":
+    unittest.main()